@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks optimize-scanned.py on synthetic scanned pages.
+
+Synthetic pages have text, a halftone photo, noise and uneven illumination. Each stage of the
+pipeline (load, crop, window_intensity, median_filter, otsu, encode, save, ...) is timed for
+each page, along with end-to-end process_file() and adaptive thresholds (vs. skimage's
+threshold_sauvola). Each measurement runs in a fresh process, so
+that its peak RSS (resident memory) is reported separately. Results are written to a json file,
+so that runs can be compared before & after a change.
+
+Copyright 2024 C Bhushan; Licensed under the Apache License v2.0.
+https://github.com/cbhushan/script-collection
+
+@author: C Bhushan
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import io
+import sys
+import time
+import json
+import random
+import string
+import pathlib
+import argparse
+import platform
+import resource
+import tempfile
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from imghelper import crop
+
+
+SCANNER_BED_INCH = (8.5, 11.7)  # synthetic pages are a bit larger than A4, like scanner bed
+STRIP_ROWS = 1024  # rows generated at once, to bound memory at high dpi
+
+
+def load_optimize_scanned():
+    """Returns optimize-scanned.py as module"""
+    if 'optimize_scanned' not in sys.modules:
+        path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'optimize-scanned.py')
+        spec = importlib.util.spec_from_file_location('optimize_scanned', path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['optimize_scanned'] = module
+        spec.loader.exec_module(module)
+    return sys.modules['optimize_scanned']
+
+
+def peak_rss():
+    """Peak resident memory of this process, in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on linux
+
+
+def smooth_field(shape, rng, cells=8):
+    """Smooth random field in [0, 1] of given (rows, cols) shape"""
+    low = Image.fromarray(np.uint8(255 * rng.random((cells, cells))))
+    return np.asarray(low.resize((shape[1], shape[0]), Image.BICUBIC), dtype=np.float32) / 255
+
+
+def synthetic_page(dpi, seed=0):
+    """
+    Returns synthetic scanned page (grayscale PIL.Image) at dpi: paragraphs of text, a halftone
+    photo, uneven illumination, gaussian noise and dust specks.
+    """
+    rng = np.random.default_rng(seed)
+    prng = random.Random(seed)
+    w, h = int(SCANNER_BED_INCH[0] * dpi), int(SCANNER_BED_INCH[1] * dpi)
+    img = Image.new('L', (w, h), 235)
+    draw = ImageDraw.Draw(img)
+
+    # halftone photo in upper half; 85 lines per inch dot screen at 45 degrees
+    px, py, pw, ph = int(1.0 * dpi), int(1.5 * dpi), int(3.5 * dpi), int(2.5 * dpi)
+    tone = smooth_field((ph, pw), rng, cells=6)
+    yy, xx = np.mgrid[0:ph, 0:pw].astype(np.float32) * (2 * np.pi * 85 / dpi / np.sqrt(2))
+    screen = (np.cos(xx + yy) + np.cos(xx - yy) + 2) / 4
+    img.paste(Image.fromarray(np.uint8(np.where(tone > screen, 235, 20))), (px, py))
+
+    # text; 11 pt font, random words
+    font = ImageFont.load_default(size=max(int(11 / 72 * dpi), 8))
+    line_height = int(1.5 * 11 / 72 * dpi)
+    y = int(0.8 * dpi)
+    while y < h - int(0.8 * dpi):
+        x = int(0.8 * dpi)
+        x_end = w - int(0.8 * dpi)
+        if py - line_height < y < py + ph:
+            x = px + pw + int(0.3 * dpi)  # wrap around photo
+        words = []
+        while x + sum(len(wd) + 1 for wd in words) * font.size * 0.5 < x_end:
+            words.append(''.join(prng.choices(string.ascii_letters, k=prng.randint(2, 10))))
+        draw.text((x, y), ' '.join(words[:-1]), fill=20, font=font)
+        y += line_height * (3 if prng.random() < 0.1 else 1)  # paragraph breaks
+
+    # uneven illumination, noise & specks; in strips to bound memory
+    arr = np.asarray(img).copy()
+    illumination = smooth_field((64, 64), rng, cells=3)
+    illumination = np.asarray(Image.fromarray(illumination).resize((w, h), Image.BILINEAR))
+    for y0 in range(0, h, STRIP_ROWS):
+        strip = arr[y0:y0 + STRIP_ROWS].astype(np.float32)
+        strip *= 0.75 + 0.25 * illumination[y0:y0 + STRIP_ROWS]
+        strip += rng.normal(0, 6, strip.shape).astype(np.float32)
+        strip[rng.random(strip.shape) < 1e-4] = 0
+        arr[y0:y0 + STRIP_ROWS] = np.clip(strip, 0, 255)
+    out = Image.fromarray(arr)
+    out.info['dpi'] = (dpi, dpi)
+    return out
+
+
+class StageTimer:
+    """Collects wall-clock time of named stages; use as `with timer('name'): ...`"""
+
+    def __init__(self):
+        self.seconds = {}
+
+    def __call__(self, name):
+        self._name = name
+        return self
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.seconds[self._name] = self.seconds.get(self._name, 0) + time.perf_counter() - self._t0
+
+
+def bench_stages(fn, out_dir, median_kernel_size=3, n_colors=2, contrast_adjust='auto'):
+    """
+    Times each stage of optimize-scanned.py's grayscale / B&W pipeline on file fn.
+    Both the step-by-step chain (window_intensity -> median_filter -> otsu) and the fused
+    window_median_otsu() used by process_file() are timed.
+    """
+    osc = load_optimize_scanned()
+    rss_start = peak_rss()
+    quantile = osc.contrast_enhance_qunatiles[contrast_adjust]
+    timer = StageTimer()
+
+    with timer('load'):
+        img = Image.open(fn)
+        img.load()
+    with timer('crop'):
+        img = crop(img, 'A4')
+    with timer('grayscale'):
+        img = img.convert('L', dither=None)
+        I = np.asarray(img)
+
+    with timer('window_intensity'):
+        W = osc.window_intensity(I, quantile)
+    if median_kernel_size is not None:
+        with timer('median_filter'):
+            osc.median_filter(I, kernel_size=median_kernel_size)  # on uint8, as in window_median_otsu()
+    with timer('otsu'):
+        osc.otsu(W, n_class=n_colors)
+    del W
+
+    with timer('window_median_otsu'):
+        oimg = osc.window_median_otsu(I, quantile, n_class=n_colors, median_kernel_size=median_kernel_size,
+                                      bilevel=(n_colors == 2))
+    out_img = osc.bilevel_image(oimg, img.size[0]) if n_colors == 2 else osc.pil_image(oimg, img)
+
+    with timer('encode'):
+        buf = io.BytesIO()
+        out_img.save(buf, format='TIFF', compression='group4' if n_colors == 2 else 'lzma', dpi=(300, 300))
+        encoded = buf.getvalue()
+    with timer('save'):
+        with open(pathlib.Path(out_dir) / f'{pathlib.Path(fn).stem}.tiff', 'wb') as f:
+            f.write(encoded)
+
+    return {
+        'seconds': timer.seconds,
+        'out_bytes': len(encoded),
+        'peak_rss_bytes': peak_rss(),
+        'start_rss_bytes': rss_start,
+    }
+
+
+def bench_process_file(fn, out_dir, **kwargs):
+    """Times end-to-end process_file() on file fn"""
+    osc = load_optimize_scanned()
+    rss_start = peak_rss()
+    t0 = time.perf_counter()
+    out_file = osc.process_file(pathlib.Path(fn), pathlib.Path(out_dir), **kwargs)
+    return {
+        'seconds': time.perf_counter() - t0,
+        'out_bytes': os.path.getsize(out_file),
+        'peak_rss_bytes': peak_rss(),
+        'start_rss_bytes': rss_start,
+    }
+
+
+def bench_adaptive(fn, method, window_size=51, strip_height=None):
+    """
+    Times adaptive (local) threshold of file fn: optimize-scanned.py's adaptive_threshold() with
+    method 'sauvola' or 'bradley', or 'skimage-sauvola' for skimage.filters.threshold_sauvola().
+    Thresholded image is returned bit-packed, to compare methods.
+    """
+    osc = load_optimize_scanned()
+    with Image.open(fn) as img:
+        I = np.asarray(crop(img, 'A4').convert('L', dither=None))
+    rss_start = peak_rss()
+    t0 = time.perf_counter()
+    if method == 'skimage-sauvola':
+        from skimage.filters import threshold_sauvola
+        out_img = I > threshold_sauvola(I, window_size=window_size)
+    else:
+        out_img = osc.adaptive_threshold(I, method, window_size=window_size, strip_height=strip_height)
+    return {
+        'seconds': time.perf_counter() - t0,
+        'peak_rss_bytes': peak_rss(),
+        'start_rss_bytes': rss_start,
+        'packed': np.packbits(out_img),
+        'n_pixels': out_img.size,
+    }
+
+
+def in_fresh_process(func, *args, **kwargs):
+    """Runs func in a new process (so that peak RSS is its own) and returns its result"""
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+        return executor.submit(func, *args, **kwargs).result()
+
+
+def run_benchmark(dpis, work_dir, repeat=1, median_kernel_size=3, n_colors=2, seed=0, threshold_window=51):
+    """Returns list of result dicts, one per dpi"""
+    results = []
+    for dpi in dpis:
+        fn = pathlib.Path(work_dir) / f'page-{dpi}dpi.png'
+        if not fn.exists():
+            print(f'[INFO] Generating synthetic page at {dpi} dpi...')
+            synthetic_page(dpi, seed=seed).save(fn, dpi=(dpi, dpi), compress_level=1)
+        out_dir = pathlib.Path(work_dir) / f'out-{dpi}dpi'
+        out_dir.mkdir(exist_ok=True)
+        with Image.open(fn) as img:
+            size = img.size
+
+        # best of repeats
+        stages = [in_fresh_process(bench_stages, fn, out_dir, median_kernel_size, n_colors)
+                  for _ in range(repeat)]
+        full = [in_fresh_process(bench_process_file, fn, out_dir, n_colors=n_colors,
+                                 median_kernel_size=median_kernel_size, crop_size='A4', out_format='tiff')
+                for _ in range(repeat)]
+        adaptive = {}
+        for method in ('sauvola', 'bradley', 'skimage-sauvola'):
+            runs = [in_fresh_process(bench_adaptive, fn, method, threshold_window) for _ in range(repeat)]
+            adaptive[method] = {
+                'seconds': min(r['seconds'] for r in runs),
+                'peak_rss_bytes': min(r['peak_rss_bytes'] for r in runs),
+                'start_rss_bytes': min(r['start_rss_bytes'] for r in runs),
+                'packed': runs[0]['packed'],
+            }
+        n_pixels = runs[0]['n_pixels']
+        n_differ = np.unpackbits(adaptive['sauvola']['packed'] ^ adaptive['skimage-sauvola']['packed']).sum()
+        for v in adaptive.values():
+            del v['packed']
+        adaptive['sauvola_vs_skimage_agreement'] = 1 - int(n_differ) / n_pixels
+
+        result = {
+            'dpi': dpi,
+            'width': size[0],
+            'height': size[1],
+            'input_bytes': os.path.getsize(fn),
+            'stage_seconds': {k: min(s['seconds'][k] for s in stages) for k in stages[0]['seconds']},
+            'stages_peak_rss_bytes': min(s['peak_rss_bytes'] for s in stages),
+            'process_file_seconds': min(r['seconds'] for r in full),
+            'process_file_peak_rss_bytes': min(r['peak_rss_bytes'] for r in full),
+            'process_file_start_rss_bytes': min(r['start_rss_bytes'] for r in full),
+            'out_bytes': full[0]['out_bytes'],
+            'adaptive_threshold': adaptive,
+        }
+        results.append(result)
+
+        stage_str = ', '.join(f'{k} {v:.2f}s' for k, v in result['stage_seconds'].items())
+        print(f'[INFO] {dpi} dpi ({size[0]}x{size[1]}): process_file {result["process_file_seconds"]:.2f}s, '
+              f'peak RSS {result["process_file_peak_rss_bytes"] / 2**20:.0f} MiB, '
+              f'output {result["out_bytes"] / 1024:.0f} KiB\n       {stage_str}')
+        print(f'       adaptive threshold (window {threshold_window}): '
+              + ', '.join(f'{k} {v["seconds"]:.2f}s' for k, v in adaptive.items() if isinstance(v, dict))
+              + f', sauvola agrees with skimage on {100 * adaptive["sauvola_vs_skimage_agreement"]:.4f}% pixels')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmarks optimize-scanned.py on synthetic scanned pages.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '-o', '--output', default='benchmark-optimize-scanned.json',
+        help='Path to output json file with results.')
+
+    parser.add_argument(
+        '--dpi', type=int, nargs='+', default=[300, 600, 1200],
+        help='Resolutions of synthetic pages. Note that 1200 dpi needs several GB of memory.')
+
+    parser.add_argument(
+        '--median-kernel-size', type=int, default=3,
+        help='Kernel size for median filtering.')
+
+    parser.add_argument(
+        '--num-colors', type=int, default=2,
+        help='Number of colors in output image.')
+
+    parser.add_argument(
+        '--threshold-window', type=int, default=51,
+        help='Window size for adaptive threshold (sauvola & bradley) benchmark.')
+
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='Number of repeats of each measurement; best (minimum) is reported.')
+
+    parser.add_argument(
+        '--work-dir', default=None,
+        help='Directory for synthetic pages & outputs; reused between runs. '
+        'When not specified, a temporary directory is used.')
+
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Random seed for synthetic pages.')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        results = run_benchmark(args.dpi, work_dir, repeat=args.repeat, median_kernel_size=args.median_kernel_size,
+                                n_colors=args.num_colors, seed=args.seed, threshold_window=args.threshold_window)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': Image.__version__,
+        'cpu_count': os.cpu_count(),
+        'options': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'[INFO] Saved: {args.output}')
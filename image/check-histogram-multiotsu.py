@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks imghelper.histogram_multiotsu() against skimage's threshold_multiotsu() and against
+brute-force search over all thresholds, on random histograms. Half of the histograms have
+non-empty bin 0 (as histograms of windowed pages, where clipped pixels pile up in bin 0).
+Also checks against skimage on full 256-bin histograms of windowed & median filtered synthetic
+pages (see benchmark-optimize-scanned.py), which are too large for brute force.
+
+Thresholds may differ on near-ties: skimage sums in float32. A different threshold is accepted
+when its between-class variance (in float64) is equal within SKIMAGE_TOLERANCE (relative; about
+float32 precision), or BRUTE_FORCE_TOLERANCE for brute force, which is in float64. Otherwise it is
+a mismatch. Exits with non-zero status when there are mismatches.
+
+Copyright 2024 C Bhushan; Licensed under the Apache License v2.0.
+https://github.com/cbhushan/script-collection
+
+@author: C Bhushan
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import sys
+import itertools
+import argparse
+import importlib.util
+import numpy as np
+from skimage.filters import threshold_multiotsu
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from imghelper import histogram_multiotsu, uint8_histogram, histogram_quantile
+
+
+# relative tolerance of between-class variance; float32 epsilon is 1.2e-7. A threshold off by
+# one bin changes between-class variance of a page histogram by up to about 1e-6.
+SKIMAGE_TOLERANCE = 4e-7
+BRUTE_FORCE_TOLERANCE = 1e-12
+
+
+def between_class_variance(hist, idx):
+    """
+    Returns between-class variance (up to constants) of thresholds idx of hist, as maximized by
+    histogram_multiotsu() & skimage (see histogram_multiotsu() for its handling of bin 0).
+    """
+    p = np.asarray(hist, dtype=np.float64)
+    nonzero = np.flatnonzero(p)
+    start = nonzero[0]
+    p = p[start:nonzero[-1] + 1]
+    moment = np.maximum(np.arange(p.size), 1) * p
+
+    edges = (0,) + tuple(int(i) - start + 1 for i in idx) + (p.size,)
+    var = 0.
+    for i, j in zip(edges[:-1], edges[1:]):
+        w = p[i:j].sum()
+        if w > 0 and (i, j) != (0, 1):
+            var += moment[i:j].sum() ** 2 / w
+    return var
+
+
+def brute_force_multiotsu(hist, n_class):
+    """
+    Returns threshold indices of histogram_multiotsu() by exhaustive search in lexicographic
+    order, with same between-class variance as skimage (see histogram_multiotsu()).
+    """
+    nonzero = np.flatnonzero(hist)
+    if len(nonzero) == n_class:
+        return nonzero[:-1]
+    start = nonzero[0]
+
+    best, best_idx = -np.inf, None
+    for idx in itertools.combinations(range(start, nonzero[-1]), n_class - 1):
+        var = between_class_variance(hist, idx)
+        if var > best:
+            best, best_idx = var, idx
+    return np.array(best_idx, dtype=np.intp)
+
+
+def random_hist(rng, max_bins):
+    n = int(rng.integers(8, max_bins + 1))
+    hist = rng.integers(0, 50, n) * (rng.random(n) < 0.7)
+    if rng.random() < 0.5:
+        hist[0] = rng.integers(1, 500)
+    return hist
+
+
+def page_hists(n_pages, dpi=50):
+    """Yields 256-bin histograms of windowed synthetic pages, as in window_median_otsu()"""
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'benchmark-optimize-scanned.py')
+    spec = importlib.util.spec_from_file_location('benchmark_optimize_scanned', path)
+    benchmark = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(benchmark)
+    osc = benchmark.load_optimize_scanned()
+
+    for seed in range(n_pages):
+        I = np.asarray(benchmark.synthetic_page(dpi, seed=seed))
+        hist = uint8_histogram(I)
+        i_min, i_max = histogram_quantile(hist, osc.contrast_enhance_qunatiles['auto'])
+        for median_kernel_size in (None, 5):
+            if median_kernel_size is not None:
+                hist = uint8_histogram(osc.median_filter(I, kernel_size=median_kernel_size))
+            counts, _, _ = osc.windowed_histogram(hist, i_min, i_max)
+            yield counts
+
+
+def compare(name, hist, n_class, ref, idx, mismatches, tolerance):
+    """
+    Returns 1 if thresholds idx & ref differ, with same between-class variance within (relative)
+    tolerance; else 0. Other differences are appended to mismatches.
+    """
+    if np.array_equal(idx, ref):
+        return 0
+    var, var_ref = between_class_variance(hist, idx), between_class_variance(hist, ref)
+    if abs(var - var_ref) <= tolerance * abs(var_ref):
+        return 1
+    mismatches.append((name, hist, n_class, ref, idx, (var - var_ref) / var_ref))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Checks histogram_multiotsu() against skimage and brute force.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '-n', '--num-hist', type=int, default=500,
+        help='Number of random histograms.')
+
+    parser.add_argument(
+        '--max-bins', type=int, default=24,
+        help='Largest number of bins of random histograms; brute force is slow for many bins.')
+
+    parser.add_argument(
+        '--num-pages', type=int, default=30,
+        help='Number of synthetic pages for 256-bin histograms (with & without median filter).')
+
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Random seed.')
+
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n_checked, n_ties, mismatches = 0, 0, []
+    for _ in range(args.num_hist):
+        hist = random_hist(rng, args.max_bins)
+        n_class = int(rng.integers(3, 6))
+        if np.count_nonzero(hist) < n_class:
+            continue
+
+        idx = histogram_multiotsu(hist, n_class)
+        n_checked += 1
+        n_ties += compare('skimage', hist, n_class, threshold_multiotsu(hist=hist, classes=n_class), idx,
+                          mismatches, SKIMAGE_TOLERANCE)
+        n_ties += compare('brute-force', hist, n_class, brute_force_multiotsu(hist, n_class), idx,
+                          mismatches, BRUTE_FORCE_TOLERANCE)
+
+    for hist in page_hists(args.num_pages):
+        for n_class in (3, 4):
+            idx = histogram_multiotsu(hist, n_class)
+            n_checked += 1
+            n_ties += compare('skimage-page', hist, n_class, threshold_multiotsu(hist=hist, classes=n_class),
+                              idx, mismatches, SKIMAGE_TOLERANCE)
+
+    for name, hist, n_class, ref, idx, rel in mismatches:
+        print(f'[ERR] {name}: {ref} != {idx} (relative variance difference {rel:.2e}) '
+              f'for {n_class} classes of {hist.tolist()}')
+    print(f'[INFO] Checked {n_checked} histograms; {n_ties} near-ties with different thresholds; '
+          f'{len(mismatches)} mismatches.')
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks quantize_colors() of optimize-scanned.py on solid pages, pages with fewer distinct colours
+than n_colors, and random pages: palette must be non-empty, have at most n_colors colours, and
+reproduce each colour of pages with fewer colours (after contrast boost; within 1 gray level, as
+mean gray level of contrast boost is estimated from sampled pixels).
+Exits with non-zero status when any check fails.
+
+Copyright 2024 C Bhushan; Licensed under the Apache License v2.0.
+https://github.com/cbhushan/script-collection
+
+@author: C Bhushan
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import sys
+import traceback
+import importlib.util
+import numpy as np
+from PIL import Image, ImageEnhance
+
+
+def load_optimize_scanned():
+    """Returns optimize-scanned.py as module"""
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'optimize-scanned.py')
+    spec = importlib.util.spec_from_file_location('optimize_scanned', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_pages(rng, size=(64, 48)):
+    """Returns dict of name: RGB page"""
+    pages = {
+        'solid-white': Image.new('RGB', size, (255, 255, 255)),
+        'solid-red': Image.new('RGB', size, (200, 30, 40)),
+    }
+    two = np.zeros(size[::-1] + (3,), dtype=np.uint8)
+    two[:size[1] // 2] = (10, 200, 30)
+    two[size[1] // 2:] = (250, 250, 0)
+    pages['two-colours'] = Image.fromarray(two)
+    pages['random'] = Image.fromarray(rng.integers(0, 256, size[::-1] + (3,), dtype=np.uint8))
+    return pages
+
+
+if __name__ == "__main__":
+    osc = load_optimize_scanned()
+    rng = np.random.default_rng(0)
+
+    failures, n_checked = [], 0
+    for name, img in test_pages(rng).items():
+        colours = np.unique(np.asarray(img).reshape(-1, 3), axis=0)
+        boosted = ImageEnhance.Contrast(img).enhance(osc.COLOR_CONTRAST)
+        expected = np.unique(np.asarray(boosted).reshape(-1, 3), axis=0).astype(int)
+        for n_colors in (3, 8, 16):
+            for error_diffusion in (True, False):
+                n_checked += 1
+                case = f'{name}, {n_colors=}, {error_diffusion=}'
+                try:
+                    out = osc.quantize_colors(img, n_colors, error_diffusion=error_diffusion)
+                except Exception:
+                    failures.append(f'{case}: {traceback.format_exc().strip().splitlines()[-1]}')
+                    continue
+
+                used = np.unique(np.asarray(out.convert('RGB')).reshape(-1, 3), axis=0).astype(int)
+                if not 0 < len(used) <= n_colors:
+                    failures.append(f'{case}: {len(used)} colours in output')
+                elif len(colours) <= n_colors and not error_diffusion and (
+                        used.shape != expected.shape or np.abs(used - expected).max() > 1):
+                    failures.append(f'{case}: colours {used.tolist()} != {expected.tolist()}')
+
+    for msg in failures:
+        print(f'[ERR] {msg}')
+    print(f'[INFO] Checked {n_checked} cases; {len(failures)} failures.')
+    sys.exit(1 if failures else 0)
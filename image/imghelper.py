@@ -72,6 +72,16 @@ def pil_image(arr, ref_image):
     return image
 
 
+def bilevel_image(packed, width):
+    """
+    Returns mode '1' PIL.Image from bit-packed rows (np.packbits(B, axis=1) of bool array B
+    with True as white) of width pixels; Pillow unpacks them as it does for encoded bilevel images.
+    """
+    packed = np.ascontiguousarray(packed, dtype=np.uint8)
+    assert packed.shape[1] == (width + 7) // 8, 'packed rows do not match width'
+    return Image.frombuffer('1', (width, packed.shape[0]), packed, 'raw', '1', 0, 1)
+
+
 def rescale_to_8bit(img):
     """Rescale min-max to 8-bit range [0, 255]"""
     arr, input_is_image = image_arr(img)
@@ -108,16 +118,23 @@ def window_intensity(image, quantile=[0.006, 0.994]):
     if isinstance(quantile, str) and quantile == 'min-max':
         i_min, i_max = I.min(), I.max()
 
-    elif isinstance(quantile, (list, tuple, np.array)) and len(quantile) == 2:
-        i_min, i_max = np.quantile(I, quantile)
+    elif isinstance(quantile, (list, tuple, np.ndarray)) and len(quantile) == 2:
+        if I.dtype == np.uint8:  # fast path; avoids sorting whole image
+            i_min, i_max = histogram_quantile(uint8_histogram(I), quantile)
+        else:
+            i_min, i_max = np.quantile(I, quantile)
 
     else:
         raise ValueError(f'Unsupported quantile input = {quantile}')
 
     # scale
-    out_img = (I - i_min) / (i_max - i_min)
-    out_img[out_img < 0] = 0
-    out_img[out_img > 1] = 1
+    if I.dtype == np.uint8:  # single pass through 256-entry lookup table
+        lut = np.clip((np.arange(256) - i_min) / (i_max - i_min), 0, 1)
+        out_img = lut[I]
+    else:
+        out_img = (I - i_min) / (i_max - i_min)
+        out_img[out_img < 0] = 0
+        out_img[out_img > 1] = 1
 
     if input_is_image:
         out_img = rescale_to_8bit(out_img)
@@ -126,6 +143,80 @@ def window_intensity(image, quantile=[0.006, 0.994]):
         return out_img
 
 
+def uint8_histogram(arr, strip_height=1024):
+    """
+    Returns 256-bin histogram (np.ndarray) of uint8 array.
+    Computed over horizontal strips of strip_height rows to avoid a full-size int copy.
+    """
+    hist = np.zeros(256, dtype=np.int64)
+    for y in range(0, arr.shape[0], strip_height):
+        hist += np.bincount(arr[y:y + strip_height].ravel(), minlength=256)
+    return hist
+
+
+def histogram_quantile(hist, quantile):
+    """
+    Returns quantile(s) of data from its histogram of integer values (hist[i] is count of value i).
+    Same as np.quantile (default linear interpolation) on the underlying data.
+    """
+    cdf = np.cumsum(hist)
+    pos = np.asarray(quantile, dtype=float) * (cdf[-1] - 1)
+    k0 = np.floor(pos).astype(np.int64)
+    k1 = np.minimum(k0 + 1, cdf[-1] - 1)
+    v0 = np.searchsorted(cdf, k0, side='right')  # value of k-th element of sorted data
+    v1 = np.searchsorted(cdf, k1, side='right')
+    return v0 + (pos - k0) * (v1 - v0)
+
+
+def histogram_multiotsu(hist, n_class):
+    """
+    Multi-level Otsu thresholding of a histogram into n_class classes.
+    Returns indices of n_class-1 thresholds; bin idx[k] is the last bin of class k. It maximizes
+    the same between-class variance as skimage's threshold_multiotsu(), but by dynamic programming
+    over cumulative moments, ie. O(n_class * nbins^2) instead of exhaustive search over all
+    thresholds. skimage sums in float32, so on near-ties (within float32 precision; common on
+    256-bin page histograms) thresholds may differ from skimage's, and from output of earlier
+    versions, by a bin or two. See check-histogram-multiotsu.py.
+    """
+    p = np.asarray(hist, dtype=np.float64)
+    n = p.size
+    nvalues = np.count_nonzero(p)
+    if nvalues < n_class:
+        raise ValueError(f'Histogram has only {nvalues} non-empty bins; cannot threshold into {n_class} classes')
+    if nvalues == n_class:  # each non-empty bin is a class
+        return np.flatnonzero(p)[:-1]
+
+    # As skimage, empty bins at both ends are dropped, first moment of (new) bin 0 is counted as
+    # p[0] (not 0 * p[0]), and class of only bin 0 scores 0. So the objective is skimage's, though
+    # its optimum may differ by a bin from exact Otsu optimum when the lowest class is small.
+    start = int(np.argmax(p > 0))
+    p = p[start:n - int(np.argmax(p[::-1] > 0))]
+    n = p.size
+
+    # between-class variance term of class with bins [i, j): F[i, j] = (S_j - S_i)^2 / (W_j - W_i)
+    W = np.concatenate([[0], np.cumsum(p)])
+    S = np.concatenate([[0], np.cumsum(np.maximum(np.arange(n), 1) * p)])
+    dW = W[None, :] - W[:, None]
+    dS = S[None, :] - S[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        F = np.where(dW > 0, dS * dS / dW, 0.)
+    F[0, 1] = 0.  # class of only bin 0, as skimage
+    F[np.tril_indices(n + 1)] = -np.inf  # classes must have at least one bin
+
+    # G[k][i]: best sum for bins [i, n) split into k+1 classes
+    G = [F[:, n]]
+    for _ in range(n_class - 1):
+        G.append(np.max(F + G[-1][None, :], axis=1))
+
+    # trace forward, taking the first (smallest) optimal threshold at each step; same tie-break
+    # as exhaustive search in lexicographic order
+    idx, i = [], 0
+    for k in range(n_class - 1, 0, -1):
+        i = int(np.argmax(F[i] + G[k - 1]))
+        idx.append(start + i - 1)
+    return np.array(idx, dtype=np.intp)
+
+
 def stretch_contast(img, quantile=[0.02, 0.99]):
     """
     Stretches contrast of input RGB Image.
@@ -150,6 +241,46 @@ def stretch_contast(img, quantile=[0.02, 0.99]):
     return rgb_img_new
 
 
+def downsample_to_dpi(img, target_dpi, src_dpi=None, mode=None):
+    """
+    Downsamples PIL.Image img to target_dpi, as early as possible. For a JPEG that is not loaded
+    yet, decoder is asked to scale down with draft() (DCT scaling by 1/2, 1/4 or 1/8) in given
+    mode ('L' or 'RGB'). Remaining integer factor uses reduce(), and anything left a box filter.
+    src_dpi (number) overrides DPI of img, when given. Images at or below target_dpi are returned
+    as they are. Output has info['dpi'] set to target_dpi, so that crop() works on it.
+    """
+    if src_dpi is not None:
+        src_dpi = (src_dpi, src_dpi)
+    elif 'dpi' in img.info:
+        src_dpi = img.info['dpi']
+    else:
+        logging.warning('Can not find DPI of input. Will skip downsampling')
+        return img
+
+    if src_dpi[0] <= target_dpi and src_dpi[1] <= target_dpi:
+        img.info['dpi'] = src_dpi
+        return img
+
+    info = dict(img.info)
+    size = (max(1, round(img.size[0] * min(target_dpi / src_dpi[0], 1))),
+            max(1, round(img.size[1] * min(target_dpi / src_dpi[1], 1))))
+
+    if img.format == 'JPEG' and mode is not None:
+        img.draft(mode, size)  # decoded size is still >= size
+
+    if img.mode not in ('L', 'RGB', 'RGBA', 'LA', 'I', 'F'):  # eg. palette or 1-bit
+        img = img.convert('L' if mode == 'L' else 'RGB')
+
+    factor = (img.size[0] // size[0], img.size[1] // size[1])
+    if max(factor) >= 2:
+        img = img.reduce(factor)  # box average
+    if img.size != size:
+        img = img.resize(size, Image.BOX)
+
+    img.info = {**info, 'dpi': (target_dpi, target_dpi)}
+    return img
+
+
 def crop(image, size_inch):
     """Crops image as per desired paper size"""
     if not isinstance(image, Image.Image):
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tiny client for daemon mode of optimize-scanned.py (see its --serve option).
+Sends the given arguments as a job to the daemon and prints output file names.
+Only uses python standard library, so it starts quickly.
+
+Usage:
+    optimize-scanned-client.py <socket> <optimize-scanned.py arguments...>
+
+Exit code is 0 on success, 1 when some pages failed and 2 when daemon is not reachable
+(so that callers can fall back to running optimize-scanned.py directly).
+
+Copyright 2024 C Bhushan; Licensed under the Apache License v2.0.
+https://github.com/cbhushan/script-collection
+
+@author: C Bhushan
+"""
+
+import os
+import sys
+import json
+import socket
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+
+    socket_path, args = sys.argv[1], sys.argv[2:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(socket_path)
+            with s.makefile('rwb') as f:
+                f.write(json.dumps({'args': args, 'cwd': os.getcwd()}).encode() + b'\n')
+                f.flush()
+                line = f.readline()
+    except OSError as e:
+        print(f'[ERR] Could not reach daemon at {socket_path}: {e}', file=sys.stderr)
+        sys.exit(2)
+
+    if not line:
+        print(f'[ERR] No reply from daemon at {socket_path}', file=sys.stderr)
+        sys.exit(2)
+
+    reply = json.loads(line)
+    for out_file in reply['out_files']:
+        print(out_file)
+    if reply.get('blank'):
+        print(f'[INFO] Skipped {len(reply["blank"])} blank pages:', file=sys.stderr)
+        for fn in reply['blank']:
+            print(f'  {fn}', file=sys.stderr)
+
+    if reply['errors']:
+        print(f'[ERR] Failed to process {len(reply["errors"])} files:', file=sys.stderr)
+        for fn, msg in reply['errors']:
+            print(f'  {fn}: {msg.strip().splitlines()[-1]}', file=sys.stderr)
+        sys.exit(1)
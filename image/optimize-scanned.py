@@ -11,26 +11,37 @@ https://github.com/cbhushan/script-collection
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 import os
+import io
+import zlib
 import shutil
 import sys
 import math
-from PIL import Image, ImageFile, ImageEnhance
+import time
+from PIL import Image, ImageFile, TiffImagePlugin, PdfParser
 import traceback
 import tempfile
 import copy
 import logging
 import argparse
+import json
+import hashlib
+import signal as sys_signal  # scipy.signal is imported as signal
+import socket
 import numpy as np
 from scipy import signal
-from skimage.filters import threshold_otsu, threshold_multiotsu
+from skimage.filters import threshold_otsu
+from skimage.exposure import histogram
 import pathlib
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Load pngs saved by GIMP with color profile https://gitlab.gnome.org/GNOME/gimp/-/issues/2111
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 sys.path.append(os.path.realpath(__file__))
 # import imghelper
-from imghelper import image_arr, pil_image, rescale_to_8bit, crop, window_intensity, paper_size_inch
+from imghelper import (image_arr, pil_image, bilevel_image, rescale_to_8bit, crop, window_intensity, paper_size_inch, downsample_to_dpi,
+                       uint8_histogram, histogram_quantile, histogram_multiotsu)
 
 
 contrast_enhance_qunatiles = {
@@ -38,10 +49,36 @@ contrast_enhance_qunatiles = {
     'auto': (0.006, 0.994),  # used to be gimp's default
 }
 
+# smallest median kernel for which median_filter_uint8() is faster than signal.medfilt2d()
+MEDIAN_LEVELS_MIN_KERNEL = 5
+
+# rough peak memory use of process_file(), in bytes per input pixel; used to limit pages in flight
+PROCESS_BYTES_PER_PIXEL = 40
+
+# manifest of inputs & options of outputs, in output directory; for skipping up-to-date files
+MANIFEST_NAME = '.optimize-scanned-manifest.json'
+
+# process_file() options that do not change output; not recorded in manifest
+NON_OUTPUT_OPTIONS = ('strip_height',)
+
+# blank page detection on thumbnail; see ink_coverage()
+BLANK_THUMBNAIL_DPI = 30
+BLANK_INK_DELTA = 40  # gray levels below local background counted as ink
+BLANK_TILE_INCH = 0.5  # tile size for local background (90th percentile of tile)
+BLANK_MARGIN = 0.05  # fraction of page ignored at each edge (scanner lid shadow, punch holes)
+BLANK_DEFAULT_COVERAGE = 0.0005
+
+# colour (dither) output; see quantize_colors()
+COLOR_CONTRAST = 1.30  # 30% more contrast, as ImageEnhance.Contrast(img).enhance(1.30)
+PALETTE_SAMPLES = 1 << 18  # random pixels used for palette
+PALETTE_KMEANS_ITER = 8
+PALETTE_BIN_BITS = 6  # bits per channel of colour bins for palette computation
+
 # dict of output-format:saving kwargs; as they are format dependent
 output_formats = {
     'png': {"optimize": True},
     'tiff': {"compression": "group4"},
+    'auto': {},  # smallest of png or tiff; see encode_smallest()
 }
 
 
@@ -58,9 +95,8 @@ def otsu(image, n_class=2, nbins=256):
         out_img = np.uint8(I > thresh)
 
     elif n_class > 2:
-        if n_class > 5:
-            print(f"[WARN] Otsu multi-thresholding with more than 5 classes is very slow! Found {n_class=}")
-        thresholds = threshold_multiotsu(I, classes=n_class, nbins=nbins)
+        counts, bin_centers = histogram(I.ravel(), nbins, source_range='image')
+        thresholds = bin_centers[histogram_multiotsu(counts, n_class)]
         out_img = np.digitize(I, bins=thresholds)  # generate multiple regions.
 
     else:
@@ -80,7 +116,10 @@ def median_filter(image, kernel_size=3):
     I, input_is_image = image_arr(image)
     assert I.ndim == 2, 'input image must be single channel (grayscale image)'
 
-    out_img = signal.medfilt2d(I, kernel_size=kernel_size)
+    if I.dtype == np.uint8 and kernel_size >= MEDIAN_LEVELS_MIN_KERNEL:
+        out_img = median_filter_uint8(I, kernel_size=kernel_size)
+    else:
+        out_img = signal.medfilt2d(I, kernel_size=kernel_size)
 
     if input_is_image:
         return pil_image(out_img, image)
@@ -88,6 +127,411 @@ def median_filter(image, kernel_size=3):
         return out_img
 
 
+def median_filter_uint8(I, kernel_size=3, strip_height=256):
+    """
+    Median filter for uint8 image I whose cost per pixel does not depend on kernel size.
+    Output is same as signal.medfilt2d(), including zero padding at edges.
+
+    The median is the number of gray levels v (weighted by gap to next present level) for which
+    count of window pixels <= v is less than half the window. Window counts are box sums from
+    cumulative sums (like column histograms of Perreault & Hebert, but over all columns at once).
+    Counts for several levels are packed in lanes of one uint64, so that one cumsum serves them
+    all; each lane is wide enough that counts never reach its high bit, which is then used to
+    compare all lanes with half window at once (SWAR). Set high bits are counted with
+    np.bitwise_count(), or on numpy < 2.0 by a multiplication that sums all lanes into the top one.
+    """
+    assert I.ndim == 2 and I.dtype == np.uint8, 'input image must be uint8 grayscale image'
+    assert kernel_size % 2 == 1, 'kernel_size must be odd'
+    k, r = kernel_size, kernel_size // 2
+    need = (k * k + 1) // 2  # median rank in window
+    bits = (k * k).bit_length() + 1
+    n_lanes = 64 // bits
+    shifts = np.arange(n_lanes, dtype=np.uint64) * np.uint64(bits)
+    high = (np.uint64(1 << (bits - 1)) << shifts).sum(dtype=np.uint64)
+    ones = (np.uint64(1) << shifts).sum(dtype=np.uint64)
+    lane_mask = np.uint64((1 << bits) - 1)
+
+    P = np.pad(I, r)  # zero padding, same as medfilt2d
+    P = np.pad(P, ((1, 0), (1, 0)), constant_values=255)  # leading row/col for cumsum differences
+
+    levels = np.flatnonzero(uint8_histogram(I))
+    if levels[0] > 0:
+        levels = np.concatenate([[0], levels])  # level for zero padding
+    steps = np.diff(levels)
+    levels = levels[:-1]  # count(<= max level) is always whole window
+
+    # per group of n_lanes levels: gray level -> packed indicators, packed half window & increments
+    groups = []
+    for g in range(0, len(levels), n_lanes):
+        lv = levels[g:g + n_lanes]
+        lut = ((np.arange(256)[:, None] <= lv).astype(np.uint64) << shifts[:len(lv)]).sum(axis=1, dtype=np.uint64)
+        half = (np.uint64(need) << shifts[:len(lv)]).sum(dtype=np.uint64)
+        increment = np.concatenate([[0], np.cumsum(steps[g:g + n_lanes])]).astype(np.uint8)
+        groups.append((lut, half, increment))
+
+    out_img = np.zeros(I.shape, dtype=np.uint8)
+    for y0 in range(0, I.shape[0], strip_height):
+        P_strip = P[y0:y0 + strip_height + k]
+        out_strip = out_img[y0:y0 + strip_height]
+        for lut, half, increment in groups:
+            c = lut[P_strip]
+            np.cumsum(c, axis=1, out=c)
+            c = c[:, k:] - c[:, :-k]  # horizontal window sums; exact modulo 2^64
+            np.cumsum(c, axis=0, out=c)
+            c = c[k:] - c[:-k]
+            c |= high
+            c -= half
+            c &= high  # high bit set in lanes with count >= need
+            if hasattr(np, 'bitwise_count'):
+                n_set = np.bitwise_count(c)
+            else:  # numpy < 2.0: sum of high bits of all lanes collects in top lane of product (SWAR)
+                c >>= np.uint64(bits - 1)
+                c *= ones
+                c >>= shifts[-1]
+                c &= lane_mask
+                n_set = c
+            out_strip += increment[n_lanes - n_set]
+    return out_img
+
+
+def windowed_histogram(hist, i_min, i_max, nbins=256):
+    """
+    Returns histogram of window_intensity() output, given 256-bin histogram of its uint8 input
+    and the window [i_min, i_max]. It is same as the histogram used by threshold_otsu() &
+    otsu() on window_intensity() output.
+
+    Returns:
+        counts, bin_centers: histogram with nbins bins
+        values: windowed value of each of 256 input gray levels
+    """
+    values = np.clip((np.arange(256) - i_min) / (i_max - i_min), 0, 1)
+    present = values[hist > 0]
+    counts, edges = np.histogram(values, bins=nbins, range=(present.min(), present.max()), weights=hist)
+    bin_centers = (edges[:-1] + edges[1:]) / 2
+    return counts, bin_centers, values
+
+
+def isolated_bits(B, width):
+    """
+    Returns bits of bit-packed rows B (np.packbits(..., axis=1)) that are set while all their
+    8 neighbours are clear. Neighbours are found by shifting whole packed rows, 8 pixels per byte op.
+    """
+    B = B.copy()
+    if width % 8:
+        B[:, -1] &= np.uint8((0xFF << (8 - width % 8)) & 0xFF)  # clear padding bits after last pixel
+    left = B >> 1  # pixel x-1 moved to x
+    left[:, 1:] |= B[:, :-1] << 7
+    right = B << 1  # pixel x+1 moved to x
+    right[:, :-1] |= B[:, 1:] >> 7
+    row = B | left | right
+    neighbours = left | right
+    neighbours[1:] |= row[:-1]
+    neighbours[:-1] |= row[1:]
+    return B & ~neighbours
+
+
+def despeckle_bilevel(packed, width):
+    """
+    Removes isolated single pixels (black dots on white and white dots on black) from bilevel
+    image given as bit-packed rows (1 is white, as mode '1' images) of width pixels.
+    """
+    black_dots = isolated_bits(~packed, width)
+    white_dots = isolated_bits(packed, width)
+    return (packed | black_dots) & ~white_dots
+
+
+def reflect_index(idx, n):
+    """
+    Reflect out of range indices into [0, n), as np.pad(mode='reflect') (edge sample not repeated).
+    Reflects repeatedly, so that indices may be farther than n out of range.
+    """
+    if n == 1:
+        return np.zeros_like(idx)
+    period = 2 * (n - 1)
+    idx = np.abs(idx) % period
+    return np.where(idx >= n, period - idx, idx)
+
+
+def box_sum(A, window_size):
+    """
+    Sum of A over window_size x window_size box around each pixel, from summed-area table
+    (integral image). A must be padded by window_size//2 on each side; output is of size of unpadded A.
+    For unsigned integer A, the table may wrap around; box sums are still exact when they fit in A.dtype.
+    """
+    S = np.zeros((A.shape[0] + 1, A.shape[1] + 1), dtype=A.dtype)
+    np.cumsum(A, axis=0, out=S[1:, 1:])
+    np.cumsum(S[1:, 1:], axis=1, out=S[1:, 1:])
+    w = window_size
+    return S[w:, w:] - S[:-w, w:] - S[w:, :-w] + S[:-w, :-w]
+
+
+def adaptive_threshold(I, method='sauvola', window_size=51, k=None, lut=None, strip_height=None, packed=False):
+    """
+    Local (adaptive) thresholding of uint8 grayscale image I, with local mean m and standard
+    deviation s over window_size x window_size box around each pixel:
+        sauvola: T = m * (1 + k * (s / 127.5 - 1)), k=0.2 by default
+        bradley: T = m * (1 - k), k=0.15 by default (Bradley & Roth)
+    Box sums are computed from summed-area tables (integral images), hence O(1) per pixel for any
+    window size. Image borders are reflected as skimage.filters.threshold_sauvola().
+
+    lut (uint8 array of 256 or None): When given, thresholds lut[I] instead of I (e.g. windowed levels).
+    When strip_height is set, works on strips of strip_height rows (plus window_size//2 rows above &
+    below) to bound memory use of temporary arrays.
+
+    Returns:
+        out_img: bool np.ndarray of size of I; True for pixels above local threshold (background).
+                 When packed, rows are bit-packed instead; see pack_bilevel().
+    """
+    assert I.ndim == 2 and I.dtype == np.uint8, 'input image must be uint8 grayscale image'
+    assert window_size % 2 == 1 and window_size > 1, 'window_size must be odd'
+    if k is None:
+        k = {'sauvola': 0.2, 'bradley': 0.15}[method]
+    r = window_size // 2
+    n = window_size * window_size
+    # box sums of squares must fit: uint32 (faster) up to window of 256
+    dtype = np.uint32 if n * 255 ** 2 < 2 ** 32 else np.uint64
+    lut = np.arange(256, dtype=dtype) if lut is None else np.asarray(lut, dtype=dtype)
+    strip_height = strip_height or I.shape[0]
+
+    out_img = np.empty((I.shape[0], (I.shape[1] + 7) // 8) if packed else I.shape, dtype=np.uint8 if packed else bool)
+    for y0 in range(0, I.shape[0], strip_height):
+        y1 = min(y0 + strip_height, I.shape[0])
+        rows = reflect_index(np.arange(y0 - r, y1 + r), I.shape[0])
+        V = np.pad(I[rows], ((0, 0), (r, r)), mode='reflect')  # padded strip
+        m = box_sum(lut[V], window_size) / n
+        if method == 'sauvola':
+            var = box_sum((lut * lut)[V], window_size) / n - m * m
+            T = m * (1 + k * (np.sqrt(np.clip(var, 0, None)) / 127.5 - 1))
+        elif method == 'bradley':
+            T = m * (1 - k)
+        else:
+            raise ValueError(f'Unknown adaptive threshold method: {method}')
+        strip = lut[I[y0:y1]] > T
+        out_img[y0:y1] = np.packbits(strip, axis=1) if packed else strip
+    return out_img
+
+
+def gray_array(img, strip_height=None):
+    """
+    Returns uint8 np.ndarray of PIL.Image img converted to grayscale ('L'). When strip_height is
+    set, img is converted in strips of strip_height rows, so that the returned array is the only
+    full-size copy made (converting whole img makes a grayscale image, and np.asarray() a copy of it).
+    """
+    if not strip_height:
+        I, _ = image_arr(img.convert('L', dither=None))
+        return I
+
+    width, height = img.size
+    I = np.empty((height, width), dtype=np.uint8)
+    for y0 in range(0, height, strip_height):
+        strip = img.crop((0, y0, width, min(y0 + strip_height, height)))
+        I[y0:y0 + strip_height] = np.asarray(strip.convert('L', dither=None))
+    return I
+
+
+def window_median_otsu(I, quantile, n_class=2, median_kernel_size=None, strip_height=None, bilevel=False,
+                       threshold='otsu', threshold_window=51, threshold_k=None, despeckle=False):
+    """
+    Fused version of window_intensity() -> median_filter() -> otsu() -> rescale_to_8bit()
+    for uint8 grayscale image I. Output is same as that chain, but no full-size float arrays are
+    created; only uint8 arrays of size of I.
+
+    Windowing is monotonic, hence it commutes with median filtering. So I is median filtered
+    directly. Window quantiles and Otsu thresholds are computed from 256-bin histograms, which
+    gives a single lookup table from gray level to output value.
+    When strip_height is set, median filter & lookup table are applied in strips of strip_height
+    rows (with overlap for median kernel), so that only I and the output are full-size. Median
+    filtered strips are then computed twice (for histogram, and for lookup table) instead of
+    keeping a median filtered copy of I; local thresholds still need that full copy.
+    threshold='sauvola' or 'bradley' (n_class=2 only) replaces global Otsu threshold by local
+    thresholds on windowed levels; see adaptive_threshold().
+    Black & white results (n_class=2) are kept bit-packed (8 pixels per byte), and despeckle
+    works on packed rows; see despeckle_bilevel().
+
+    Returns:
+        out_img: when bilevel (n_class=2), bit-packed rows of I (see bilevel_image()); else
+                 uint8 np.ndarray of same size as I
+    """
+    assert I.ndim == 2 and I.dtype == np.uint8, 'input image must be uint8 grayscale image'
+    strip_height = strip_height or I.shape[0]
+
+    hist = uint8_histogram(I)
+    if isinstance(quantile, str) and quantile == 'min-max':
+        quantile = (0, 1)
+    i_min, i_max = histogram_quantile(hist, quantile)
+
+    if median_kernel_size is None:
+        M = I
+    elif strip_height >= I.shape[0]:
+        M = median_filter(I, kernel_size=median_kernel_size)
+    else:
+        M = None  # median filtered strips are computed when needed
+
+    def median_strips():
+        """Yields (y0, median filtered rows y0:y0 + strip_height of I)"""
+        r = median_kernel_size // 2 if M is None else 0
+        for y0 in range(0, I.shape[0], strip_height):
+            if M is not None:
+                yield y0, M[y0:y0 + strip_height]
+                continue
+            y1 = min(y0 + strip_height, I.shape[0])
+            lo, hi = max(y0 - r, 0), min(y1 + r, I.shape[0])  # overlap for median kernel
+            yield y0, median_filter(I[lo:hi], kernel_size=median_kernel_size)[y0 - lo:y1 - lo]
+
+    if median_kernel_size is not None:
+        hist = sum(uint8_histogram(strip) for _, strip in median_strips())
+
+    counts, bin_centers, values = windowed_histogram(hist, i_min, i_max)
+    if threshold != 'otsu':  # local thresholds on windowed 8-bit levels, instead of global Otsu
+        if n_class != 2:
+            raise ValueError(f'{threshold} threshold is only for black & white output (n_class=2)')
+        if M is None:
+            median = np.empty_like(I)
+            for y0, strip in median_strips():
+                median[y0:y0 + strip_height] = strip
+            M = median
+        packed = adaptive_threshold(
+            M, threshold, window_size=threshold_window, k=threshold_k,
+            lut=np.uint8(np.round(255 * values)), strip_height=strip_height, packed=True)
+
+    elif bilevel or despeckle:
+        if n_class != 2:
+            raise ValueError('despeckle is only for black & white output (n_class=2)')
+        lut = values > threshold_otsu(hist=(counts, bin_centers))
+        packed = np.empty((I.shape[0], (I.shape[1] + 7) // 8), dtype=np.uint8)
+        for y0, strip in median_strips():
+            packed[y0:y0 + strip_height] = np.packbits(lut[strip], axis=1)
+
+    else:
+        if n_class == 2:
+            thresholds = np.array([threshold_otsu(hist=(counts, bin_centers))])
+        else:
+            thresholds = bin_centers[histogram_multiotsu(counts, n_class)]
+
+        # lookup table: gray level -> output
+        label = np.digitize(values, bins=thresholds)
+        l_min, l_max = label[hist > 0].min(), label[hist > 0].max()  # min-max as rescale_to_8bit()
+        lut = np.uint8(255.0 * (label - l_min) / max(l_max - l_min, 1))
+
+        out_img = np.empty(I.shape, dtype=lut.dtype)
+        for y0, strip in median_strips():
+            out_img[y0:y0 + strip_height] = lut[strip]
+        return out_img
+
+    if despeckle:
+        packed = despeckle_bilevel(packed, I.shape[1])
+    if bilevel:
+        return packed
+    return np.uint8(255) * np.unpackbits(packed, axis=1, count=I.shape[1])
+
+
+def ink_coverage(img, dpi=None):
+    """
+    Returns (coverage, std) of page img from a thumbnail of about BLANK_THUMBNAIL_DPI: fraction
+    of thumbnail pixels that are BLANK_INK_DELTA gray levels darker than local background, and
+    standard deviation of difference from local background. Takes a few milliseconds per page,
+    mostly for Image.reduce(). Faint bleed-through, noise & specks are not counted as ink.
+    dpi overrides DPI of img; 300 is assumed when neither is known.
+    """
+    dpi = dpi or img.info.get('dpi', (300, 300))[0] or 300
+    factor = max(int(dpi // BLANK_THUMBNAIL_DPI), 1)
+    if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        img = img.convert('L')
+    T = np.asarray(img.reduce(factor).convert('L'), dtype=np.float32)
+    m = int(BLANK_MARGIN * min(T.shape))
+    T = T[m:T.shape[0] - m, m:T.shape[1] - m]
+
+    n = max(min(int(BLANK_TILE_INCH * dpi / factor), *T.shape), 1)
+    rows, cols = T.shape[0] // n, T.shape[1] // n
+    tiles = T[:rows * n, :cols * n].reshape(rows, n, cols, n).transpose(0, 2, 1, 3).reshape(rows, cols, -1)
+    background = Image.fromarray(np.percentile(tiles, 90, axis=2).astype(np.float32))
+    background = np.asarray(background.resize((T.shape[1], T.shape[0]), Image.BILINEAR))
+    D = background - T
+    return float(np.mean(D >= BLANK_INK_DELTA)), float(D.std())
+
+
+def median_cut(points, weights, n_colors):
+    """
+    Returns labels (box index of each point) of median cut of weighted colour points into at most
+    n_colors boxes. The box with largest weighted squared error is split at weighted median of
+    its widest (largest variance) channel. Boxes of a single point are never split, so there are
+    fewer than n_colors boxes when there are fewer points.
+    """
+    labels = np.zeros(len(points), dtype=np.intp)
+    sse = [np.inf if len(points) > 1 else 0.]
+    for n_boxes in range(1, n_colors):
+        box = int(np.argmax(sse))
+        if sse[box] <= 0:
+            break
+        idx = np.flatnonzero(labels == box)
+        p, w = points[idx], weights[idx]
+        mean = np.average(p, axis=0, weights=w)
+        axis = np.argmax(np.average((p - mean) ** 2, axis=0, weights=w))
+        order = np.argsort(p[:, axis], kind='stable')
+        cw = np.cumsum(w[order])
+        split = int(np.clip(np.searchsorted(cw, cw[-1] / 2), 1, len(idx) - 1))
+        labels[idx[order[split:]]] = n_boxes
+
+        errors = []
+        for sel in (order[:split], order[split:]):
+            pb, wb = p[sel], w[sel]
+            errors.append(np.sum(wb[:, None] * (pb - np.average(pb, axis=0, weights=wb)) ** 2))
+        sse[box] = errors[0]
+        sse.append(errors[1])
+    return labels
+
+
+def quantize_colors(img, n_colors, contrast=COLOR_CONTRAST, error_diffusion=True, seed=0):
+    """
+    Returns palette (mode 'P') image of RGB image img with n_colors colours, after contrast boost
+    like ImageEnhance.Contrast(img).enhance(contrast).
+
+    Palette is computed from PALETTE_SAMPLES random pixels, binned in colour cube (64x64x64):
+    median cut of bin centroids (weighted by pixel count) refined by a few k-means iterations.
+    Contrast is per-channel affine, so instead of boosting contrast of whole image, img is mapped
+    to the palette with contrast undone (pixel c is nearest to palette colour p after contrast
+    boost iff c is nearest to p with contrast undone; up to clipping). Mapping to the palette is
+    done by Pillow's Image.quantize(), which caches nearest palette colour in a 3D lookup table,
+    with Floyd-Steinberg dithering when error_diffusion is True.
+    """
+    img = img if img.mode == 'RGB' else img.convert('RGB')
+    A = np.asarray(img).reshape(-1, 3)
+    rng = np.random.default_rng(seed)
+    sample = A[rng.integers(0, len(A), min(PALETTE_SAMPLES, len(A)))].astype(np.float64)
+    del A
+
+    # contrast as ImageEnhance.Contrast(): around mean gray level; truncated & clipped as Pillow's blend
+    mean = int(np.mean(sample @ [0.299, 0.587, 0.114]) + 0.5)
+    sample = np.clip(mean + contrast * (sample - mean), 0, 255).astype(np.uint8).astype(np.float64)
+
+    # weighted centroids of colour bins
+    bits = PALETTE_BIN_BITS
+    code = (sample.astype(np.intp) >> (8 - bits)) @ [1 << (2 * bits), 1 << bits, 1]
+    bins, code = np.unique(code, return_inverse=True)
+    weights = np.bincount(code).astype(np.float64)
+    points = np.stack([np.bincount(code, weights=sample[:, c]) for c in range(3)], axis=1) / weights[:, None]
+
+    labels = median_cut(points, weights, n_colors)
+    for _ in range(PALETTE_KMEANS_ITER + 1):
+        counts = np.bincount(labels, weights=weights)
+        keep = counts > 0
+        palette = np.stack([np.bincount(labels, weights=weights * points[:, c]) for c in range(3)], axis=1)
+        palette = palette[keep] / counts[keep, None]
+        dist = (palette ** 2).sum(axis=1) - 2 * points @ palette.T  # squared distance, less |points|^2
+        new_labels = np.argmin(dist, axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    palette = np.round(palette)
+
+    undone = Image.new('P', (1, 1))
+    undone.putpalette(np.uint8(np.clip(np.round(mean + (palette - mean) / contrast), 0, 255)).ravel().tolist())
+    out_img = img.quantize(
+        palette=undone, dither=Image.Dither.FLOYDSTEINBERG if error_diffusion else Image.Dither.NONE)
+    out_img.putpalette(np.uint8(palette).ravel().tolist())
+    return out_img
+
+
 def input_file_list(arg_in):
     """
     Returns list of pathlib file-names to operate on.
@@ -121,9 +565,343 @@ def input_file_list(arg_in):
     return file_in
 
 
+def palette_image(img):
+    """
+    Returns (image, bits) for saving img as png with fewest bits per pixel: 'L' images with at
+    most 16 gray levels are converted to palette ('P') images. bits is None for 8-bit images.
+    """
+    if img.mode == 'L':
+        arr = np.asarray(img)
+        levels = np.flatnonzero(uint8_histogram(arr))
+        if len(levels) > 16:
+            return img, None
+        lut = np.zeros(256, dtype=np.uint8)
+        lut[levels] = np.arange(len(levels))
+        img = Image.fromarray(lut[arr], mode='P')
+        img.putpalette(np.repeat(levels, 3).astype(np.uint8).tobytes())
+        n = len(levels)
+    elif img.mode == 'P':
+        n = int(np.asarray(img).max()) + 1
+    else:
+        return img, None
+
+    for bits in (1, 2, 4):
+        if n <= 2 ** bits:
+            return img, bits
+    return img, None
+
+
+def encode_candidates(img):
+    """Returns list of (name, PIL format, image, save kwargs) to try in encode_smallest()"""
+    candidates = []
+    if img.mode == '1':
+        single_strip = math.ceil(img.size[0] / 8) * img.size[1]  # so that pdf can embed G4 as is
+        candidates.append(('tiff-group4', 'TIFF', img, {"compression": "group4", "strip_size": single_strip}))
+        png_img, bits = img, None  # 1-bit png
+    else:
+        candidates.append(('tiff-lzma', 'TIFF', img, {"compression": "lzma"}))
+        candidates.append(('tiff-deflate', 'TIFF', img, {"compression": "tiff_adobe_deflate"}))
+        png_img, bits = palette_image(img)
+
+    bits_kwargs = {"bits": bits} if bits else {}
+    name = f'png{bits}bit' if bits else 'png'
+    for level in (6, 9):
+        candidates.append((f'{name}-{level}', 'PNG', png_img, {"compress_level": level, **bits_kwargs}))
+    candidates.append((f'{name}-optimize', 'PNG', png_img, {"optimize": True, **bits_kwargs}))
+    return candidates
+
+
+def encode_smallest(img, save_kwargs, tiff_only=False):
+    """
+    Encodes img with each of encode_candidates() in parallel threads and returns
+    (extension, bytes) of the smallest one. Sizes & times of all candidates are printed.
+    save_kwargs (eg. dpi) are used for all candidates.
+    """
+    def encode(candidate):
+        name, fmt, cimg, kwargs = candidate
+        t0 = time.perf_counter()
+        buf = io.BytesIO()
+        cimg.copy().save(buf, format=fmt, **save_kwargs, **kwargs)  # save() keeps kwargs in image; not thread-safe
+        return name, fmt, buf.getvalue(), time.perf_counter() - t0
+
+    candidates = [c for c in encode_candidates(img) if c[1] == 'TIFF' or not tiff_only]
+    with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+        results = list(executor.map(encode, candidates))
+
+    name, fmt, encoded, _ = min(results, key=lambda r: len(r[2]))
+    sizes = ', '.join(f'{r[0]}: {len(r[2]) / 1024:.1f} KiB in {r[3] * 1e3:.0f} ms' for r in results)
+    print(f'[INFO] Encoded sizes: {sizes}; using {name}')
+    return fmt.lower(), encoded
+
+
+def file_sha256(fn):
+    """Returns sha256 hex digest of contents of file fn"""
+    sha = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def manifest_key(fn):
+    return str(pathlib.Path(fn).resolve())
+
+
+def manifest_entry(fn, out_file, out_top):
+    """
+    Returns manifest entry (dict) for input fn whose output out_file was just saved;
+    out_file is None for skipped blank page.
+    """
+    st = os.stat(fn)
+    return {
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'sha256': file_sha256(fn),
+        'output': None if out_file is None else os.path.relpath(out_file, out_top),
+        'output_size': None if out_file is None else os.path.getsize(out_file),
+    }
+
+
+def load_manifest(out_top, options):
+    """
+    Returns manifest entries (dict: input file -> entry) from output directory out_top.
+    Returns empty dict when there is no manifest, or it was recorded with different options.
+    """
+    try:
+        with open(pathlib.Path(out_top) / MANIFEST_NAME) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if manifest.get('options') != options:
+        print(f'[INFO] Options changed since last run in {out_top}; all files will be processed.')
+        return {}
+    return manifest.get('files', {})
+
+
+def save_manifest(out_top, options, entries):
+    """Atomically writes manifest of output directory out_top"""
+    path = pathlib.Path(out_top) / MANIFEST_NAME
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'options': options, 'files': entries}, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def is_current(fn, entry, out_top):
+    """
+    Returns True when output recorded in manifest entry for input fn is up-to-date, ie. output
+    exists unchanged (or input was a blank page), and input has same size & mtime, or same content
+    hash (entry is then updated with new mtime).
+    """
+    if entry is None:
+        return False
+
+    if entry['output'] is not None:
+        out_file = pathlib.Path(out_top) / entry['output']
+        if not out_file.exists() or out_file.stat().st_size != entry['output_size']:
+            return False
+
+    st = os.stat(fn)
+    if st.st_size != entry['size']:
+        return False
+    if st.st_mtime_ns == entry['mtime_ns']:
+        return True
+    if file_sha256(fn) == entry['sha256']:  # touched, but unchanged
+        entry['mtime_ns'] = st.st_mtime_ns
+        return True
+    return False
+
+
+def available_memory():
+    """Returns available physical memory in bytes; None when it can not be determined"""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def page_memory(fn):
+    """Returns rough estimate of peak memory (bytes) needed by process_file() for input fn"""
+    try:
+        with Image.open(fn) as img:  # only reads header
+            return img.size[0] * img.size[1] * PROCESS_BYTES_PER_PIXEL
+    except Exception:
+        return 0
+
+
+class MultipageWriter:
+    """
+    Writes pages to a multipage TIFF or PDF file (chosen by extension of path), appending each
+    page as soon as it is given. Pages are encoded single-page image files, as returned by
+    process_file(..., to_bytes=True).
+
+    TIFF pages are copied as they are. In PDF, CCITT G4 compressed (single-strip) TIFF pages are
+    embedded as they are, with CCITTFaxDecode filter; other pages are decoded and embedded with
+    FlateDecode.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.n_pages = 0
+        self.is_pdf = self.path.suffix.lower() == '.pdf'
+        if self.is_pdf:
+            self._fp = open(self.path, 'wb')
+            self._offsets = {}  # object number -> byte offset
+            self._page_refs = []
+            self._fp.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+            self._write_obj(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        else:
+            self._tf = TiffImagePlugin.AppendingTiffWriter(str(self.path), True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, page):
+        """Appends page (bytes of encoded image file)"""
+        if self.is_pdf:
+            self._append_pdf(page)
+        else:
+            self._tf.write(page)
+            self._tf.newFrame()
+        self.n_pages += 1
+
+    def close(self):
+        if self.is_pdf:
+            if self._fp.closed:
+                return
+            kids = b' '.join(b'%d 0 R' % ref for ref in self._page_refs)
+            self._write_obj(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self._page_refs)))
+            n_obj = max(self._offsets) + 1
+            xref = self._fp.tell()
+            self._fp.write(b'xref\n0 %d\n0000000000 65535 f \n' % n_obj)
+            for num in range(1, n_obj):
+                self._fp.write(b'%010d 00000 n \n' % self._offsets[num])
+            self._fp.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (n_obj, xref))
+            self._fp.close()
+        else:
+            self._tf.close()
+
+    def check(self):
+        """Re-opens closed file with Pillow and raises RuntimeError when its page count is not n_pages"""
+        if self.is_pdf:
+            n_frames = len(PdfParser.PdfParser(str(self.path)).pages)
+        else:
+            with Image.open(self.path) as img:
+                n_frames = img.n_frames
+        if n_frames != self.n_pages:
+            raise RuntimeError(f'{self.path} has {n_frames} pages; expected {self.n_pages}')
+
+    def _write_obj(self, num, body, stream=None):
+        self._offsets[num] = self._fp.tell()
+        self._fp.write(b'%d 0 obj\n' % num + body)
+        if stream is not None:
+            self._fp.write(b'\nstream\n' + stream + b'\nendstream')
+        self._fp.write(b'\nendobj\n')
+
+    def _append_pdf(self, page):
+        img = Image.open(io.BytesIO(page))
+        width, height = img.size
+        dpi = img.info.get('dpi', (72, 72))
+        tags = getattr(img, 'tag_v2', {})
+
+        if tags.get(259) == 4 and len(tags.get(273, ())) == 1:  # compression=group4, single strip
+            offset, count = tags[273][0], tags[279][0]
+            stream = page[offset:offset + count]
+            black_is_1 = b'true' if tags.get(262) == 1 else b'false'  # photometric: black is zero
+            image_dict = (b'/Filter [/CCITTFaxDecode] /DecodeParms [<< /K -1 /BlackIs1 %s /Columns %d /Rows %d >>] '
+                          b'/BitsPerComponent 1 /ColorSpace /DeviceGray' % (black_is_1, width, height))
+        else:
+            if img.mode == 'P':
+                palette = img.getpalette()
+                colorspace = b'[/Indexed /DeviceRGB %d <%s>]' % (len(palette) // 3 - 1, bytes(palette).hex().encode())
+            else:
+                img = img.convert('L' if img.mode in ('1', 'L', 'LA', 'I;16') else 'RGB')
+                colorspace = b'/DeviceGray' if img.mode == 'L' else b'/DeviceRGB'
+            stream = zlib.compress(img.tobytes())
+            image_dict = b'/Filter /FlateDecode /BitsPerComponent 8 /ColorSpace %s' % colorspace
+
+        # page size in points; image drawn over full page
+        w_pt, h_pt = 72.0 * width / dpi[0], 72.0 * height / dpi[1]
+        num = max(self._offsets) + 1 if len(self._offsets) > 1 else 3  # object 2 (pages) is written last
+        self._write_obj(num, b'<< /Type /XObject /Subtype /Image /Width %d /Height %d %s /Length %d >>' % (
+            width, height, image_dict, len(stream)), stream)
+        content = b'q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q' % (w_pt, h_pt)
+        self._write_obj(num + 1, b'<< /Length %d >>' % len(content), content)
+        self._write_obj(num + 2, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] '
+                                 b'/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>' % (
+                                     w_pt, h_pt, num, num + 1))
+        self._page_refs.append(num + 2)
+
+
+def process_files(file_in_list, out_top, jobs=1, memory_limit=None, writer=None, **kwargs):
+    """
+    Runs process_file() on all files in file_in_list using `jobs` worker processes.
+    Results are reported in input order. At most `jobs` pages are in flight; fewer when their
+    estimated memory need (see page_memory()) exceeds memory_limit (bytes; default: 75% of
+    available memory). A single page is always allowed, even if it exceeds memory_limit.
+    When writer (MultipageWriter) is given, pages are appended to it in input order, instead
+    of being saved as separate files.
+
+    Returns:
+        out_files: list of saved output file names; None for skipped blank pages (see skip_blank)
+        errors: list of (input file, formatted traceback) for pages that failed
+    """
+    out_files, errors = [], []
+    if writer is not None:
+        kwargs['to_bytes'] = True
+
+    def report(fn, get_result):
+        try:
+            out_file = get_result()
+            if out_file is None:  # blank page
+                out_files.append(None)
+                return
+            if writer is not None:
+                writer.append(out_file)
+                out_file = writer.path
+            out_files.append(out_file)
+            logging.info(f'Saved {out_file}')
+        except Exception:
+            logging.error(f'Encoutered error while processing: {fn}:\n\n {traceback.format_exc()}')
+            errors.append((fn, traceback.format_exc()))
+
+    if jobs <= 1:
+        for fn in file_in_list:
+            report(fn, lambda: process_file(fn, out_top, **kwargs))
+        return out_files, errors
+
+    if memory_limit is None:
+        avail = available_memory()
+        memory_limit = 0.75 * avail if avail else float('inf')
+
+    in_flight = collections.deque()  # (fn, future, memory); in input order
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for fn in file_in_list:
+            mem = page_memory(fn)
+            while in_flight and (len(in_flight) >= jobs
+                                 or sum(m for _, _, m in in_flight) + mem > memory_limit):
+                done_fn, future, _ = in_flight.popleft()
+                report(done_fn, future.result)
+            in_flight.append((fn, executor.submit(process_file, fn, out_top, **kwargs), mem))
+
+        while in_flight:
+            done_fn, future, _ = in_flight.popleft()
+            report(done_fn, future.result)
+
+    return out_files, errors
+
+
 def process_file(
         fn, out_top, n_colors=2, dither=False, crop_size=None, median_kernel_size=None, contrast_adjust='auto',
-        set_dpi=None, keep_original=False, out_format='png', overwrite_fn_okay=False):
+        set_dpi=None, keep_original=False, out_format='png', overwrite_fn_okay=False, strip_height=None,
+        to_bytes=False, target_dpi=None, threshold='otsu', threshold_window=51, threshold_k=None,
+        despeckle=False, skip_blank=None, error_diffusion=True):
     """
     Process one input image file.
 
@@ -141,16 +919,36 @@ def process_file(
                                  DPI from input image, when available.
         keep_original (bool or str): If True or "true", keeps a copy of the original file with suffix "orig_"
                                      in `out_top` folder.
-        out_format (str): Output image format ('png', 'tiff').
+        out_format (str): Output image format ('png', 'tiff', 'auto'). 'auto' picks the smallest encoding
+                          among png & tiff candidates for each page; see encode_smallest().
         overwrite_fn_okay (bool): If True, allows overwriting the input file.
+        strip_height (int or None): When set, grayscale & B&W (non-dither) outputs are converted to
+                                    grayscale, median filtered & thresholded in horizontal strips of
+                                    strip_height rows. Peak memory is then about decoded page plus its
+                                    grayscale copy; median filter takes twice as long.
+                                    See gray_array() & window_median_otsu().
+        target_dpi (float or None): When set, input is downsampled to this DPI right after decoding (see
+                                    downsample_to_dpi()), and output DPI is target_dpi. set_dpi is then
+                                    used as DPI of the input, when given.
+        to_bytes (bool): If True, returns encoded output image (bytes) instead of saving it in out_top.
+                         B&W tiff is then a single G4 strip, which MultipageWriter can embed in PDF.
+        threshold (str): 'otsu' (global), 'sauvola' or 'bradley' (local) threshold for B&W output (n_colors=2
+                         without dither). See adaptive_threshold().
+        threshold_window (int): Window size (odd) for local thresholds.
+        threshold_k (float or None): k parameter of local thresholds; None for method's default.
+        despeckle (bool): Remove isolated single pixels from B&W output (n_colors=2 without dither).
+        skip_blank (float or None): When set, pages with ink coverage (see ink_coverage()) below it are
+                                    not processed nor saved, and None is returned.
+        error_diffusion (bool): Floyd-Steinberg dithering when mapping colour output (n_colors > 2 with
+                                dither) to its palette (default). See quantize_colors().
 
     ToDo:
      - add Blurring if required
     """
     assert n_colors > 1, 'Need atleast 2 colors!'
-    out_file = out_top / f'{fn.stem}.{out_format}'
-    if (out_file == fn) and not overwrite_fn_okay:
-        msg = (f'[ERR] Input file and output file are same!\nInput: {fn}\nOutput: {out_file}.\n'
+    out_exts = ('png', 'tiff') if out_format == 'auto' else (out_format,)
+    if fn in [out_top / f'{fn.stem}.{ext}' for ext in out_exts] and not overwrite_fn_okay:
+        msg = (f'[ERR] Input file and output file are same!\nInput: {fn}\nOutput: {fn}.\n'
                f'\nEither change output directory or set overwrite_fn_okay to True')
         raise ValueError(msg)
 
@@ -160,6 +958,17 @@ def process_file(
 
     save_kwargs = copy.deepcopy(output_formats[out_format])
     img_orig = Image.open(fn)
+    gray_output = n_colors == 2 or not dither
+
+    if target_dpi is not None:
+        img_orig = downsample_to_dpi(img_orig, target_dpi, src_dpi=set_dpi, mode='L' if gray_output else 'RGB')
+    info = img_orig.info
+
+    if skip_blank is not None:  # before expensive stages
+        coverage, _ = ink_coverage(img_orig, dpi=set_dpi if target_dpi is None else None)
+        if coverage < skip_blank:
+            print(f'[INFO] Skipped blank page (ink coverage {100 * coverage:.3f}%): {fn}')
+            return None
 
     if crop_size is not None:
         img = crop(img_orig, crop_size)
@@ -167,27 +976,29 @@ def process_file(
         img = img_orig
 
     # final output is grayscale or black & white
-    if n_colors == 2 or not dither:  # mono-chrome; single channel OR black & white
-        img = img.convert('L', dither=None)  # grayscale
-
-        I, _ = image_arr(img)
-        oimg = window_intensity(I, contrast_enhance_qunatiles[contrast_adjust])
-
-        if median_kernel_size is not None:
-            oimg = median_filter(oimg, kernel_size=median_kernel_size)
-
-        if not dither:  # use otsu
-            oimg = otsu(oimg, n_class=n_colors)
-
-            if out_format == 'tiff' and n_colors == 2:
-                oimg = oimg > 0  # make it 1-bit/sample
-            else:  # pngs or grayscale
-                oimg = rescale_to_8bit(oimg)
-
-            out_img = pil_image(oimg, img)
+    if gray_output:  # mono-chrome; single channel OR black & white
+        if not dither:  # window, median filter & otsu; see window_median_otsu()
+            width = img.size[0]
+            I = gray_array(img, strip_height=strip_height)  # grayscale
+            del img, img_orig  # decoded page is not needed anymore; only I is full-size
+            bilevel = out_format in ('tiff', 'auto') and n_colors == 2  # 1-bit/sample for tiff
+            oimg = window_median_otsu(
+                I, contrast_enhance_qunatiles[contrast_adjust], n_class=n_colors,
+                median_kernel_size=median_kernel_size, strip_height=strip_height, bilevel=bilevel,
+                threshold=threshold, threshold_window=threshold_window, threshold_k=threshold_k,
+                despeckle=despeckle)
+            del I
+            out_img = bilevel_image(oimg, width) if bilevel else pil_image(oimg, None)
 
         else:  # dither using PIL; must be n_color=2
             assert n_colors == 2
+            img = img.convert('L', dither=None)  # grayscale
+            I, _ = image_arr(img)
+            oimg = window_intensity(I, contrast_enhance_qunatiles[contrast_adjust])
+
+            if median_kernel_size is not None:
+                oimg = median_filter(oimg, kernel_size=median_kernel_size)
+
             oimg = rescale_to_8bit(oimg)
             oimg = pil_image(oimg, img)
             out_img = oimg.convert(
@@ -198,14 +1009,7 @@ def process_file(
                 )
 
     else:  # RGB colored; n_colors > 2 and dither
-        enhancer = ImageEnhance.Contrast(img)
-        img = enhancer.enhance(1.30)  # 30% more contast
-        out_img = img.convert(
-            mode='P',
-            colors=n_colors,
-            dither=Image.Dither.FLOYDSTEINBERG,
-            palette=Image.Palette.ADAPTIVE,
-            )
+        out_img = quantize_colors(img, n_colors, error_diffusion=error_diffusion)  # with 30% more contast
 
     # adjust saving kwargs if needed
     if out_format == 'tiff':
@@ -214,11 +1018,31 @@ def process_file(
         else:
             save_kwargs["compression"] = "lzma"
 
-    if set_dpi is not None:  # must be number; overrides input-image's dpi
+    if target_dpi is not None and 'dpi' in info:  # downsampled
+        save_kwargs["dpi"] = info['dpi']
+
+    elif set_dpi is not None:  # must be number; overrides input-image's dpi
         save_kwargs["dpi"] = (set_dpi, set_dpi)
 
-    elif 'dpi' in img_orig.info:
-        save_kwargs["dpi"] = img_orig.info['dpi']
+    elif 'dpi' in info:
+        save_kwargs["dpi"] = info['dpi']
+
+    if out_format == 'auto':
+        out_format, encoded = encode_smallest(out_img, save_kwargs, tiff_only=to_bytes)
+        if to_bytes:
+            return encoded
+        out_file = out_top / f'{fn.stem}.{out_format}'
+        with open(out_file, 'wb') as f:
+            f.write(encoded)
+        print(f'[INFO] Saved: {out_file}')
+        return out_file
+
+    if to_bytes:
+        if out_format == 'tiff' and out_img.mode == '1':
+            save_kwargs["strip_size"] = math.ceil(out_img.size[0] / 8) * out_img.size[1]  # single strip
+        buf = io.BytesIO()
+        out_img.save(buf, format=out_format.upper(), **save_kwargs)
+        return buf.getvalue()
 
     out_file = out_top / f'{fn.stem}.{out_format}'
     out_img.save(out_file, **save_kwargs)
@@ -227,20 +1051,20 @@ def process_file(
     return out_file
 
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser(
         description='Optimizes scanned documents for archival purposes.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     requiredNamed = parser.add_argument_group('Required named arguments')
     requiredNamed.add_argument(
-        '-i', '--input', required=True,
+        '-i', '--input',
         help='Path to input filename (or directory). It can also be the "save path" as returned by Gnome Simple-Scan. ' \
         'When directory, it process all valid files (png, jpeg, jpg, tiff) in this top level directory; NOT recursive.')
 
     requiredNamed.add_argument(
         '-o', '--output-dir',
-        help='Path to output folder/directory', required=True)
+        help='Path to output folder/directory')
 
     parser.add_argument(
         "--out-format", choices=list(output_formats.keys()),
@@ -270,37 +1094,222 @@ if __name__ == "__main__":
         "--median-kernel-size", type=int, default=None,
         help="Set kernel size for median filtering. When not specified, no median filtering is done.")
 
+    parser.add_argument(
+        "--threshold", choices=['otsu', 'sauvola', 'bradley'], default='otsu',
+        help="Thresholding for black & white output (--num-colors 2 without --dither). 'otsu' uses one "
+        "threshold for the page; 'sauvola' & 'bradley' use local thresholds, better for uneven "
+        "illumination & shadows.")
+
+    parser.add_argument(
+        "--threshold-window", type=int, default=51,
+        help="Window size (odd, in pixels) for local mean & variance of sauvola / bradley threshold.")
+
+    parser.add_argument(
+        "--threshold-k", type=float, default=None,
+        help="k parameter of sauvola (default 0.2) or bradley (default 0.15) threshold.")
+
+    parser.add_argument(
+        "--despeckle", action='store_true', default=False,
+        help="Remove isolated single black & white pixels (dust, noise) from black & white output "
+        "(--num-colors 2 without --dither). Cheaper than --median-kernel-size, as it works on the "
+        "1-bit page.")
+
+    parser.add_argument(
+        "--skip-blank", type=float, nargs='?', const=BLANK_DEFAULT_COVERAGE, default=None, metavar='COVERAGE',
+        help="Skip blank pages (eg. backs of duplex scans): pages whose ink coverage, estimated on a small "
+        f"thumbnail, is below COVERAGE (fraction of page; {BLANK_DEFAULT_COVERAGE} when not given) are not "
+        "processed nor saved. Skipped pages are listed at the end.")
+
+    parser.add_argument(
+        "--no-error-diffusion", dest='error_diffusion', action='store_false', default=True,
+        help="With --dither and --num-colors more than 2, map colors to the nearest palette color without "
+        "Floyd-Steinberg error diffusion. Faster and smaller files, but banding in photos & gradients.")
+
     parser.add_argument(
         "--set-dpi", type=float, default=None,
         help="Set DPI in image meta data.")
 
+    parser.add_argument(
+        "--target-dpi", type=float, default=None,
+        help="Downsample input to this DPI right after decoding (eg. scan at 600 and archive at 300). "
+        "When --set-dpi is also given, it is used as DPI of the input.")
 
-    if len(sys.argv) == 1:
-        parser.print_help(sys.stderr)
-        sys.exit(1)
+    parser.add_argument(
+        "--strip-height", type=int, default=None,
+        help="Process grayscale / black & white pages in horizontal strips of this many rows, "
+        "to reduce peak memory for very large scans (e.g. 1200 dpi A3): about decoded page plus one "
+        "8-bit copy of it, instead of four or five such copies. Decoded page is still held whole, and "
+        "--median-kernel-size takes twice as long. When not specified, whole page is processed at once.")
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of pages to process in parallel (separate processes). "
+        "Fewer pages are processed in parallel when they may not fit in available memory.")
 
+    parser.add_argument(
+        "--force", action='store_true', default=False,
+        help="Process all files. By default, files whose outputs are up-to-date (same input file contents "
+        "and options, as recorded in manifest file in output directory) are skipped.")
+
+    parser.add_argument(
+        "--merge", default=None,
+        help="Write all pages to this single multipage file (.tiff or .pdf) in output directory, "
+        "instead of one file per page. Pages are appended as they finish; in pdf, B&W tiff pages "
+        "are embedded as CCITT G4 without re-encoding.")
+
+    parser.add_argument(
+        "--serve", default=None, metavar='SOCKET',
+        help="Run as daemon that processes jobs sent to this Unix socket by optimize-scanned-client.py. "
+        "Jobs are the usual arguments of this script; keeps python modules loaded between scans.")
+    return parser
 
+
+def run(args):
+    """
+    Processes files as per parsed command line args.
+    Unless args.force or args.merge is set, files whose outputs are up-to-date as per manifest in
+    output directory are skipped; see is_current().
+
+    Returns:
+        file_in_list: list of input files
+        out_files: list of saved (or up-to-date) output file names
+        errors: list of (input file, formatted traceback) for pages that failed
+        blank_files: list of input files skipped as blank pages (see --skip-blank)
+    """
     file_in_list = input_file_list(args.input)
     out_top = pathlib.Path(args.output_dir)
     os.makedirs(out_top, exist_ok=True)
 
-
-    for fn in file_in_list:
+    options = dict(
+        n_colors=args.num_colors,
+        dither=args.dither,
+        crop_size=args.crop_size,
+        contrast_adjust=args.contrast_adjust,
+        median_kernel_size=args.median_kernel_size,
+        set_dpi=args.set_dpi,
+        target_dpi=args.target_dpi,
+        out_format=args.out_format,
+        strip_height=args.strip_height,
+        threshold=args.threshold,
+        threshold_window=args.threshold_window,
+        threshold_k=args.threshold_k,
+        despeckle=args.despeckle,
+        skip_blank=args.skip_blank,
+        error_diffusion=args.error_diffusion,
+    )
+    output_options = {k: v for k, v in options.items() if k not in NON_OUTPUT_OPTIONS}
+
+    writer = MultipageWriter(out_top / args.merge) if args.merge else None
+    if writer is not None and not writer.is_pdf and options['out_format'] not in ('tiff', 'auto'):
+        # AppendingTiffWriter can only append tiff pages
+        print(f'[INFO] Pages are encoded as tiff (instead of {options["out_format"]}) for merged tiff: {writer.path}')
+        options['out_format'] = 'tiff'
+    use_manifest = writer is None
+    entries = load_manifest(out_top, output_options) if use_manifest and not args.force else {}
+
+    todo = [fn for fn in file_in_list if not (use_manifest and is_current(fn, entries.get(manifest_key(fn)), out_top))]
+    if len(todo) < len(file_in_list):
+        print(f'[INFO] Skipping {len(file_in_list) - len(todo)} files with up-to-date outputs. Use --force to reprocess.')
+
+    processed, errors = process_files(todo, out_top, jobs=args.jobs, writer=writer, **options)
+    failed = {fn for fn, _ in errors}
+    if writer is not None:
+        writer.close()
+        writer.check()
+        print(f'[INFO] Saved {writer.n_pages} pages in: {writer.path}')
+        blank_files = [fn for fn, out_file in zip([fn for fn in todo if fn not in failed], processed) if out_file is None]
+        return file_in_list, [out_file for out_file in processed if out_file is not None], errors, blank_files
+
+    # record processed files in manifest; process_files() keeps input order
+    for fn, out_file in zip([fn for fn in todo if fn not in failed], processed):
+        entries[manifest_key(fn)] = manifest_entry(fn, out_file, out_top)
+    save_manifest(out_top, output_options, entries)
+
+    outputs = [(fn, entries[manifest_key(fn)]['output']) for fn in file_in_list if fn not in failed]
+    out_files = [out_top / output for _, output in outputs if output is not None]
+    blank_files = [fn for fn, output in outputs if output is None]
+    return file_in_list, out_files, errors, blank_files
+
+
+def serve(socket_path):
+    """
+    Serves jobs on Unix socket at socket_path, one at a time, until interrupted.
+    A job is a json line {"args": [command line args], "cwd": "working dir"}. Reply is a json line
+    {"out_files": [...], "errors": [[input file, message], ...], "blank": [skipped blank input files]}.
+    See optimize-scanned-client.py.
+    """
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(socket_path)
+                raise RuntimeError(f'Another daemon is already serving on {socket_path}')
+            except ConnectionRefusedError:
+                os.remove(socket_path)  # stale socket
+
+    sys_signal.signal(sys_signal.SIGTERM, lambda *_: sys.exit(0))  # remove socket on termination
+
+    parser = get_parser()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        server.listen()
+        print(f'[INFO] Serving on: {socket_path}')
         try:
-            outfn = process_file(
-                fn, out_top,
-                n_colors=args.num_colors,
-                dither=args.dither,
-                crop_size=args.crop_size,
-                contrast_adjust=args.contrast_adjust,
-                median_kernel_size=args.median_kernel_size,
-                set_dpi=args.set_dpi,
-                out_format=args.out_format
-            )
-            logging.info(f'Saved {outfn}')
+            while True:
+                conn, _ = server.accept()
+                with conn, conn.makefile('rwb') as f:
+                    line = f.readline()
+                    if not line:  # eg. connection check by another daemon
+                        continue
+                    try:
+                        job = json.loads(line)
+                        os.chdir(job.get('cwd', '/'))
+                        try:
+                            args = parser.parse_args(job['args'])
+                        except SystemExit:
+                            raise ValueError(f'Invalid arguments: {job["args"]}')
+                        if args.input is None or args.output_dir is None:
+                            raise ValueError('-i/--input and -o/--output-dir are required')
+                        _, out_files, errors, blank_files = run(args)
+                        reply = {
+                            'out_files': list(dict.fromkeys(str(fn) for fn in out_files)),
+                            'errors': [[str(fn), msg] for fn, msg in errors],
+                            'blank': [str(fn) for fn in blank_files],
+                        }
+                    except Exception:
+                        logging.error(f'Encoutered error in job:\n\n {traceback.format_exc()}')
+                        reply = {'out_files': [], 'errors': [['', traceback.format_exc()]], 'blank': []}
+                    try:
+                        f.write(json.dumps(reply).encode() + b'\n')
+                        f.flush()
+                    except OSError:
+                        logging.warning('Client disconnected before reply')
+        finally:
+            os.remove(socket_path)
 
-        except Exception:
-            logging.error(f'Encoutered error while processing: {fn}:\n\n {traceback.format_exc()}')
 
+if __name__ == "__main__":
+    parser = get_parser()
+    if len(sys.argv) == 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        sys.exit(0)
+    if args.input is None or args.output_dir is None:
+        parser.error('the following arguments are required: -i/--input, -o/--output-dir')
+
+    file_in_list, out_files, errors, blank_files = run(args)
+
+    print(f'[INFO] Processed {len(out_files)} of {len(file_in_list)} files.')
+    if blank_files:
+        print(f'[INFO] Skipped {len(blank_files)} blank pages:')
+        for fn in blank_files:
+            print(f'  {fn}')
+    if errors:
+        print(f'[ERR] Failed to process {len(errors)} files:')
+        for fn, msg in errors:
+            print(f'  {fn}: {msg.strip().splitlines()[-1]}')
+        sys.exit(1)
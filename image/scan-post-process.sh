@@ -15,6 +15,10 @@ Although, only 3rd argument is used by this script.
 Usage:
    ${0} <mime> <keep_orig> <filename>
 
+Scans are processed faster when optimize-scanned.py daemon is running, eg. started at login:
+   python optimize-scanned.py --serve "\${XDG_RUNTIME_DIR:-/tmp}/optimize-scanned.sock"
+Otherwise, optimize-scanned.py is run directly.
+
 Inspired by: https://gist.github.com/marcosrogers/fc0250a52490e92ab8293bd781231a7e
 
 Copyright C Bhushan; Licensed under the Apache License v2.0.
@@ -40,7 +44,8 @@ TEMPDIR="$(mktemp -d)"
 DOCKERIMAGE="jbarlow83/ocrmypdf:v16.10.0"
 DOCKERARGS="--rm -i --user "$(id -u):$(id -g)" -v ${TEMPDIR}:${TEMPDIR} -v /mnt:/mnt -v /home:/home"
 OCRMYPDF="docker run ${DOCKERARGS} ${DOCKERIMAGE} -v 1 -O1"
-IMG2PDF="docker run ${DOCKERARGS} --entrypoint img2pdf ${DOCKERIMAGE} -v"
+PYTHON=/home/chitresh/opt/miniforge3/envs/scan_docs/bin/python
+SOCKET="${XDG_RUNTIME_DIR:-/tmp}/optimize-scanned.sock"
 
 # Enable debugging only for function
 function optimize_ocr() {
@@ -51,12 +56,12 @@ function optimize_ocr() {
 
     set -x
 
-    /home/chitresh/opt/miniforge3/envs/scan_docs/bin/python "${script_dir}/optimize-scanned.py" \
-    -i "${filename}" \
-    -o "${TEMPDIR}" \
-    --out-format tiff
+    optimize_args=(-i "${filename}" -o "${TEMPDIR}" --out-format tiff --merge merged.pdf)
 
-    ${IMG2PDF} -o "${TEMPDIR}/merged.pdf" ${TEMPDIR}/*.tiff
+    "${PYTHON}" "${script_dir}/optimize-scanned-client.py" "${SOCKET}" "${optimize_args[@]}"
+    if [ $? -eq 2 ]; then  # daemon not running
+        "${PYTHON}" "${script_dir}/optimize-scanned.py" "${optimize_args[@]}"
+    fi
 
     ${OCRMYPDF} "${TEMPDIR}/merged.pdf" "${filename}.pdf"
 
@@ -18,17 +18,47 @@ Steps:
     - meme_candidates.txt: absolute path to files classifed as memes. To actually
       delete files run `xargs -a meme_candidates.txt rm`
     - classification_dashbaord.html: HTML dashboard showing classification & scores.
+      It loads thumbnails/ and classification_dashbaord_data/ from review folder.
     - classification_report.csv: csv form of classification_dashbaord.html
+    - meme_clusters.csv: clusters of near-duplicate meme candidates (only with --cluster).
+      Review folder & dashboard then show one representative per cluster.
+    - classification_checkpoint.json: progress of classification. An interrupted
+      run continues from last finished batch when run again (use --restart to
+      start over). Changing images, prompts or thresholds also starts over.
     - ocr_text_fraction.pklz: File with OCR text-fraction results. OCR is slowest
       step; useful for caching when
-  - Review thumbnails and dashboard. Then
-    - If things look good: `xargs -a meme_candidates.txt rm`
+    - clip_image_features.pklz: File with normalized CLIP image embeddings. Used
+      by --sweep to tune prompts/thresholds without re-running the classifier.
+  - Review thumbnails and dashboard. Delete symlinks of files that should be kept. Then
+    - If things look good: run again with --proceed-to-delete (or --proceed-to-move).
+      This only acts on files in meme_candidates.txt whose symlink is still present
+      and that did not change since classification. It does not load CLIP/OCR models.
+    - Or, without review: `xargs -a meme_candidates.txt rm`
     - Tweak CLIP prompts (label variable below)
     - Tweak other thresholds
 
+Tuning prompts & thresholds (offline; reuses cached features from a previous run):
+  - Hand-label a small set of files in a csv with columns image_path,label where
+    label is meme or keep. A corrected copy of classification_report.csv also
+    works (label_decision column is used).
+  - Optionally, write candidate prompt sets to a json file: a list of dicts with
+    same structure as labels variable below.
+  - Run python whatsapp_cleaner.py /path/to/whatsapp/media /path/to/tmp/review \
+        --sweep labeled.csv --sweep-prompts prompt_sets.json
+  - sweep_report.csv (in review folder) lists precision/recall for all
+    combinations of prompt-set, THRESHOLD & MIN_TEXT_RATIO.
+
+Speed-up on CPU-only machines:
+  - Run once with --benchmark 128 to find fastest batch size & number of threads
+    for this machine. These are saved in ~/.cache/whatsapp_cleaner and used by
+    later runs.
+
 Environment:
     - Started with empty miniforge python 3.12.12 environment.
     - Then: pip install torch torchvision open_clip_torch pillow tqdm
+    - Optional, for faster CPU-only runs with --backend onnx-int8:
+      pip install onnx onnxruntime
+    - Optional, for --videos: ffmpeg & ffprobe in PATH, or pip install av
 
 Copyright 2026. C Bhushan; Licensed under the Apache License v2.0.
 https://github.com/cbhushan/script-collection
@@ -38,93 +68,141 @@ ChatGPT and Google (AI Mode).
 '''
 import os
 import shutil
-import torch
-import open_clip
 from PIL import Image
 from tqdm import tqdm
-import imagehash
 import csv
 import traceback
 from pathlib import Path
 from pprint import pprint
 import numpy as np
 from PIL import Image, ImageEnhance
-import easyocr
 import pickle
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import argparse
+import random
+import math
+import time
+import io
+import subprocess
+from collections import Counter
+# ML stack (torch, open_clip, easyocr) is imported after --proceed-to-* handling below,
+# so that delete/move does not pay for its (slow) import.
+
+
+def read_clusters(clusters_csv):
+    """Returns dict of image_path: (representative_path, cluster_size) from meme_clusters.csv (if any)"""
+    clusters = {}
+    if os.path.exists(clusters_csv):
+        with open(clusters_csv, newline="") as f:
+            for row in csv.DictReader(f):
+                clusters[row["image_path"]] = (row["representative_path"], int(row["cluster_size"]))
+    return clusters
+
+
+def read_candidates(manifest_path, csv_path, clusters_csv):
+    """
+    Returns list of (path, review_path, file_size, file_mtime_ns) of meme candidates listed in
+    manifest_path (meme_candidates.txt). review_path is path whose symlink in review folder
+    decides about this candidate: the candidate itself, or representative of its cluster
+    (see --cluster). Size & mtime at classification time are read from csv_path, when
+    available; otherwise they are None.
+    """
+    with open(manifest_path) as f:
+        paths = [line.rstrip("\n") for line in f if line.strip()]
+
+    file_stats = {}
+    if os.path.exists(csv_path):
+        with open(csv_path, newline="") as f:
+            for row in csv.DictReader(f):
+                if row.get("file_size") and row.get("file_mtime_ns"):
+                    file_stats[row["image_path"]] = (int(row["file_size"]), int(row["file_mtime_ns"]))
+
+    clusters = read_clusters(clusters_csv)
+    return [(path, clusters.get(path, (path,))[0], *file_stats.get(path, (None, None))) for path in paths]
 
 
-def rm_target_using_ref(ref_root, target_root):
+def apply_to_candidates(candidates, source_root, review_root, action, n_workers=8):
     """
-    Delete files from target_root if the corresponding files are present
-    in ref_root.
-    - travers files recursively on ref_root
-    - computes its relative path wrt ref_root
-    - if corresponding relative path wrt target_root exists, it is deleted.
-    - folders are skipped and not deleted.
+    Applies action(path, rel_path) to meme candidates using a bounded thread pool.
+    A candidate is skipped when:
+      - symlink of its review_path in review_root was removed during review ("unreviewed")
+      - it no longer exists ("missing")
+      - its size or mtime changed since classification ("changed")
+    A symlink in review_root is removed once action succeeded on all candidates that it
+    decides about.
+    Returns dict of status: count.
     """
-    count = 0
-    for root, dirs, files in os.walk(ref_root):
-        for file in files:
-            # Get the full path of the file in ref_root
-            ref_file_path = os.path.join(root, file)
+    def apply_one(path, review_path, file_size, file_mtime_ns):
+        rel_path = os.path.relpath(path, source_root)
+        ref_file_path = os.path.join(review_root, os.path.relpath(review_path, source_root))
+        if not os.path.islink(ref_file_path):
+            return ref_file_path, "unreviewed"
 
-            # Get relative path from ref_root
-            rel_path = os.path.relpath(ref_file_path, ref_root)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return ref_file_path, "missing"
+        if file_size is not None and (st.st_size, st.st_mtime_ns) != (file_size, file_mtime_ns):
+            print(f"Skipping file changed since classification: {path}")
+            return ref_file_path, "changed"
 
-            # Construct corresponding path in target_root
-            target_file_path = os.path.join(target_root, rel_path)
+        try:
+            action(path, rel_path)
+            return ref_file_path, "done"
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            print(f"Error while processing {path}:")
+            traceback.print_exc()
+            return ref_file_path, "error"
 
-            # Delete if it exists
-            if os.path.exists(target_file_path) and os.path.isfile(target_file_path):
-                os.remove(target_file_path)
-                os.remove(ref_file_path)
-                count+= 1
-    return count
+    counts = {}
+    not_done = set()  # symlinks with atleast one candidate that was not processed
+    done = set()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for ref_file_path, status in executor.map(lambda c: apply_one(*c), candidates):
+            counts[status] = counts.get(status, 0) + 1
+            (done if status == "done" else not_done).add(ref_file_path)
 
+    for ref_file_path in done - not_done:
+        os.remove(ref_file_path)
+    return counts
 
-def move_from_target_using_ref(ref_root, target_root, destination_root):
-    """
-    Moves files from target_root if the corresponding files are present
-    in ref_root. File are moved to destination_root & follow same relative
-    directory structure.
-    - travers files recursively on ref_root
-    - computes its relative path wrt ref_root
-    - if corresponding relative path wrt target_root exists, it is moved.
-    - folders are skipped and not deleted.
-    """
-    os.makedirs(destination_root, exist_ok=True)
-    count = 0
-    for root, dirs, files in os.walk(ref_root):
-        for file in files:
-            # Get the full path of the file in ref_root
-            ref_file_path = os.path.join(root, file)
 
-            # Get relative path from ref_root
-            rel_path = os.path.relpath(ref_file_path, ref_root)
+def rm_file(path, rel_path):
+    os.remove(path)
+
 
-            # Construct corresponding path in target_root
-            target_file_path = os.path.join(target_root, rel_path)
+def mover(destination_root):
+    """
+    Returns action(path, rel_path) for apply_to_candidates() that moves path to destination_root,
+    following same relative directory structure. Existing files are not overwritten; a counter
+    is added to file name instead.
+    """
+    lock = threading.Lock()
+    reserved = set()  # destination names picked by other threads, but not yet moved
 
-            # move if it exists
-            if os.path.exists(target_file_path) and os.path.isfile(target_file_path):
-                dest_file = os.path.join(destination_root, rel_path)
+    def move_file(path, rel_path):
+        dest_file = os.path.join(destination_root, rel_path)
 
-                # Handle existing files by adding counter
-                if os.path.exists(dest_file):
-                    base, ext = os.path.splitext(dest_file)
-                    counter = 2
-                    while os.path.exists(f"{base}_{counter}{ext}"):
-                        counter += 1
-                    dest_file = f"{base}_{counter}{ext}"
+        # Handle existing files by adding counter
+        with lock:
+            if os.path.exists(dest_file) or dest_file in reserved:
+                base, ext = os.path.splitext(dest_file)
+                counter = 2
+                while os.path.exists(f"{base}_{counter}{ext}") or f"{base}_{counter}{ext}" in reserved:
+                    counter += 1
+                dest_file = f"{base}_{counter}{ext}"
+            reserved.add(dest_file)
 
-                # Create destination directory if needed
-                os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+        # Create destination directory if needed
+        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+        shutil.move(path, dest_file)
 
-                shutil.move(target_file_path, dest_file)
-                os.remove(ref_file_path)
-                count+= 1
-    return count
+    return move_file
 
 
 def delete_empty_dir_recursively(root_path):
@@ -178,10 +256,124 @@ parser.add_argument(
     help="If set, moves files from SOURCE_DIR that match meme candidates in REVIEW_DIR to DESTINATION_DIR"
 )
 
+parser.add_argument(
+    "--apply-workers",
+    type=int,
+    default=8,
+    help="Number of parallel delete/move operations for --proceed-to-delete & --proceed-to-move. "
+         "Helps on network (FUSE/SMB) mounts."
+)
+
+parser.add_argument(
+    "--sweep",
+    type=str,
+    metavar="LABELED_CSV",
+    help="If set, sweeps prompt-sets & thresholds over hand-labeled files in LABELED_CSV "
+         "(columns: image_path,label with label as meme/keep) and writes sweep_report.csv to REVIEW_DIR"
+)
+
+parser.add_argument(
+    "--sweep-prompts",
+    type=str,
+    metavar="PROMPTS_JSON",
+    help="Json file with list of candidate prompt-sets (same structure as labels) for --sweep. "
+         "Current labels and its leave-one-prompt-out variants are always included."
+)
+
+parser.add_argument(
+    "--ocr-prefilter-recall",
+    type=float,
+    metavar="RECALL",
+    help="If set, skips OCR for images that a cheap text-presence check finds to be without text. "
+         "Check is calibrated to keep at least RECALL (e.g. 0.99) of images with text fraction "
+         "> MIN_TEXT_RATIO. Writes ocr_prefilter_report.csv to REVIEW_DIR."
+)
+
+parser.add_argument(
+    "--videos",
+    action="store_true",
+    help="If set, also classifies videos (mp4, 3gp, mov, ...) from a few low resolution keyframes. "
+         "Needs PyAV (pip install av) or ffmpeg & ffprobe in PATH."
+)
+
+parser.add_argument(
+    "--cluster",
+    action="store_true",
+    help="If set, groups near-duplicate meme candidates (e.g. same forward with different crop or "
+         "watermark) using CLIP embeddings. Only one symlink per cluster is kept in REVIEW_DIR; "
+         "review decision on it applies to whole cluster."
+)
+
+parser.add_argument(
+    "--ocr-coarse-to-fine",
+    action="store_true",
+    help="If set, runs OCR at low resolution first and repeats it at full OCR resolution only "
+         "for images with small text or text fraction close to MIN_TEXT_RATIO."
+)
+
+parser.add_argument(
+    "--restart",
+    action="store_true",
+    help="If set, ignores checkpoint of an interrupted classification run and starts over"
+)
+
+parser.add_argument(
+    "--backend",
+    choices=["torch", "onnx-int8"],
+    default="torch",
+    help="Backend for CLIP image encoder. onnx-int8 exports image encoder to ONNX once, "
+         "quantizes it to int8 and runs it with onnxruntime; useful on CPU-only machines."
+)
+
+parser.add_argument(
+    "--num-threads", "--onnx-threads",
+    dest="num_threads",
+    type=int,
+    help="Number of CPU threads for image encoder (torch.set_num_threads or onnxruntime intra-op "
+         "threads). Default: from --benchmark, when available; otherwise library default. "
+         "--onnx-threads is an old name of this option."
+)
+
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    help="Batch size for image encoder. Default: from --benchmark, when available; otherwise BATCH_SIZE."
+)
+
+parser.add_argument(
+    "--benchmark",
+    type=int,
+    metavar="N_SAMPLES",
+    help="If set, measures images/sec of decode, preprocess, encode_image & OCR on N_SAMPLES random "
+         "images from SOURCE_DIR, searches batch size & threads for encode_image and saves the fastest "
+         "for later runs. Writes benchmark_report.json to REVIEW_DIR."
+)
+
+parser.add_argument(
+    "--validate-onnx",
+    type=int,
+    metavar="N_SAMPLES",
+    help="If set, compares decisions of onnx-int8 & torch (fp32) image encoders on N_SAMPLES random "
+         "images from SOURCE_DIR and writes onnx_validation_report.csv to REVIEW_DIR"
+)
+
 # ====== CONFIG ======
-BATCH_SIZE = 32    # depends on GPU VRAM
+BATCH_SIZE = 32    # depends on GPU VRAM; on CPU, use --benchmark to find the best one
+
+# search grid for --benchmark
+BENCHMARK_BATCH_SIZES = [1, 4, 8, 16, 32, 64]
+BENCHMARK_THREADS = sorted({1, 2, 4, 8, 16, os.cpu_count() or 1} & set(range(1, (os.cpu_count() or 1) + 1)))
+BENCHMARK_OCR_IMAGES = 8  # OCR is slow; only few images are used
 THRESHOLD = 0.04   # margin b/w meme- & photo-similarity; Use conservative thresholds
 MIN_TEXT_RATIO = 0.13  # OCR area ratio threshold for text
+VIDEO_KEYFRAMES = 4  # number of keyframes used to classify a video
+VIDEO_FRAME_SIZE = 480  # px; longest side of keyframes
+CLUSTER_SIMILARITY = 0.92  # min cosine similarity of CLIP embeddings of near-duplicates for --cluster
+OCR_FINE_SIZE = 1200  # px; longest side of images for OCR
+OCR_COARSE_SIZE = 512  # px; longest side for first OCR pass with --ocr-coarse-to-fine
+OCR_SMALL_TEXT_PX = 12  # text boxes shorter than this in coarse pass need fine resolution
+OCR_ESCALATION_MARGIN = 0.04  # coarse text fraction within this of MIN_TEXT_RATIO needs fine pass
+OCR_PREFILTER_CALIBRATION = 300  # images with OCR results used to calibrate --ocr-prefilter-recall
 
 # CLIP prompts for two classes; max of prediction-score across any of the prompt-in-class is used.
 labels = {
@@ -203,13 +395,26 @@ labels = {
     ]
 }
 
+THUMBNAIL_SIZE = 150  # px; longest side of thumbnails in dashboard
+
+# Grid of thresholds for --sweep
+SWEEP_THRESHOLDS = np.round(np.arange(-0.02, 0.1001, 0.005), 4)
+SWEEP_TEXT_RATIOS = np.round(np.arange(0.05, 0.3001, 0.01), 4)
+
 # ====================
 
 args = parser.parse_args()
 SOURCE_DIR = os.path.abspath(args.source_dir)
+CACHE_DIR = os.path.expanduser("~/.cache/whatsapp_cleaner")  # exported ONNX models, tuned config
+TUNED_CONFIG_FILE = os.path.join(CACHE_DIR, "tuned_config.json")
 REVIEW_DIR = os.path.abspath(args.review_dir)
 os.makedirs(REVIEW_DIR, exist_ok=True)
 
+report_path = os.path.join(REVIEW_DIR, "meme_candidates.txt")  # path to files classifed as memes
+csv_path = os.path.join(REVIEW_DIR, "classification_report.csv")  # csv with scores etc.
+html_path = os.path.join(REVIEW_DIR, "classification_dashbaord.html")
+clusters_path = os.path.join(REVIEW_DIR, "meme_clusters.csv")  # clusters of near-duplicate memes
+
 
 # Delete files if --proceed-to-delete flag is set
 if args.proceed_to_delete:
@@ -226,8 +431,9 @@ if args.proceed_to_delete:
         exit(0)
 
     print(f"\nProceeding to delete meme files from {SOURCE_DIR}")
-    n_files = rm_target_using_ref(REVIEW_DIR, SOURCE_DIR)
-    print(f"Deleted {n_files} matching files")
+    candidates = read_candidates(report_path, csv_path, clusters_path)
+    counts = apply_to_candidates(candidates, SOURCE_DIR, REVIEW_DIR, rm_file, n_workers=args.apply_workers)
+    print(f"Deleted {counts.pop('done', 0)} matching files; skipped: {counts}")
     delete_empty_dir_recursively(REVIEW_DIR)
     exit(0)
 
@@ -248,33 +454,48 @@ if args.proceed_to_move:
         exit(0)
 
     print(f"\nProceeding to move meme files from {SOURCE_DIR} to {dest_dir}")
-    n_files = move_from_target_using_ref(REVIEW_DIR, SOURCE_DIR, dest_dir)
-    print(f"Moved {n_files} matching files to {dest_dir}")
+    os.makedirs(dest_dir, exist_ok=True)
+    candidates = read_candidates(report_path, csv_path, clusters_path)
+    counts = apply_to_candidates(candidates, SOURCE_DIR, REVIEW_DIR, mover(dest_dir), n_workers=args.apply_workers)
+    print(f"Moved {counts.pop('done', 0)} matching files to {dest_dir}; skipped: {counts}")
     delete_empty_dir_recursively(REVIEW_DIR)
     exit(0)
 
 
-report_path = os.path.join(REVIEW_DIR, "meme_candidates.txt")  # path to files classifed as memes
-csv_path = os.path.join(REVIEW_DIR, "classification_report.csv")  # csv with scores etc.
-html_path = os.path.join(REVIEW_DIR, "classification_dashbaord.html")
+import torch
+import open_clip
+import imagehash
+import easyocr
+
+try:  # optional; only needed for --backend onnx-int8
+    import onnxruntime
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except Exception:
+    onnxruntime = None
+
+try:  # optional; faster keyframe extraction for --videos, otherwise ffmpeg is used
+    import av
+except Exception:
+    av = None
 
 # file with text-fraction calculation; can be cached to fine-tune text prompts
 ocr_result_file = os.path.join(REVIEW_DIR, "ocr_text_fraction.pklz")
+ocr_prefilter_path = os.path.join(REVIEW_DIR, "ocr_prefilter_report.csv")
 
-# ---- Clean old symlinks from REVIEW_DIR recursively ----
-for root, dirs, files in os.walk(REVIEW_DIR):
-    for entry in files + dirs:
-        full_path = os.path.join(root, entry)
+# file with normalized CLIP image embeddings; used for tuning prompts & thresholds
+clip_feature_file = os.path.join(REVIEW_DIR, "clip_image_features.pklz")
+sweep_path = os.path.join(REVIEW_DIR, "sweep_report.csv")
+onnx_validation_path = os.path.join(REVIEW_DIR, "onnx_validation_report.csv")
+benchmark_path = os.path.join(REVIEW_DIR, "benchmark_report.json")
 
-        # Remove only symbolic links
-        if os.path.islink(full_path):
-            os.unlink(full_path)
-delete_empty_dir_recursively(REVIEW_DIR)
+# classification progress; used to resume interrupted runs
+checkpoint_path = os.path.join(REVIEW_DIR, "classification_checkpoint.json")
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
 # ------------------ OCR ------------------
 reader = easyocr.Reader(["en"], gpu=torch.cuda.is_available())
+ocr_pass_counts = Counter()  # number of images finished at coarse/fine resolution
 
 # ------------------ Utilities ------------------
 def preprocess_image(img_path):
@@ -288,45 +509,228 @@ def preprocess_image(img_path):
     img = enhancer.enhance(1.1)
     return img
 
-def text_area_ratio(img):
+def text_boxes(img):
+    """Returns list of (width, height) of text boxes found by OCR in img"""
+    boxes = []
+    for b in reader.readtext(np.asarray(img)):
+        points = b[0]
+        width = points[1][0] - points[0][0]
+        height = points[2][1] - points[1][1]
+        boxes.append((width, height))
+    return boxes
+
+def text_area_ratio(img, boxes=None):
     img = np.asarray(img)
     total_area = img.shape[0] * img.shape[1]
     if total_area < 2:  # ~ 1 px!
         return 0
 
-    results = reader.readtext(img)
-    total_text_area = 0
-    for b in results:
-        points = b[0]
-        width = points[1][0] - points[0][0]
-        height = points[2][1] - points[1][1]
-        total_text_area += width * height
+    if boxes is None:
+        boxes = text_boxes(img)
+    total_text_area = sum(width * height for width, height in boxes)
 
     txt_faction = total_text_area / total_area
     return txt_faction
 
-def get_ocr_results(img_paths, cache_file):
-    """Compute ocr txt fraction and cache it"""
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
+VIDEO_EXTENSIONS = {".mp4", ".3gp", ".mov", ".mkv", ".webm", ".avi"}
+
+def is_video(path):
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+def _scale_frame(img, size):
+    img = img.convert("RGB")
+    img.thumbnail((size, size), Image.BILINEAR)
+    return img
+
+def extract_keyframes(path, n_frames=VIDEO_KEYFRAMES, size=VIDEO_FRAME_SIZE):
+    """
+    Returns list of upto n_frames keyframes (PIL.Image; longest side <= size px) spread
+    over the video at path. Only keyframes are decoded; uses PyAV when available,
+    otherwise ffmpeg & ffprobe (must be in PATH).
+    """
+    frames = []
+    if av is not None:
+        with av.open(path) as container:
+            stream = container.streams.video[0]
+            stream.codec_context.skip_frame = "NONKEY"
+            duration = container.duration / av.time_base if container.duration else 0
+            for i in range(n_frames):
+                t = duration * (i + 0.5) / n_frames
+                container.seek(int(t / stream.time_base), stream=stream)
+                for frame in container.decode(stream):
+                    frames.append(_scale_frame(frame.to_image(), size))
+                    break
+        return frames
+
+    cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path]
+    duration = float(subprocess.check_output(cmd).strip() or 0)
+    scale = f"scale='if(gt(iw,ih),min({size},iw),-2)':'if(gt(iw,ih),-2,min({size},ih))'"
+    for i in range(n_frames):
+        t = duration * (i + 0.5) / n_frames
+        cmd = ['ffmpeg', '-v', 'error', '-skip_frame', 'nokey', '-ss', f'{t:.3f}', '-i', path,
+               '-frames:v', '1', '-vf', scale, '-f', 'image2pipe', '-vcodec', 'png', '-']
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+        if out:
+            frames.append(Image.open(io.BytesIO(out)).convert("RGB"))
+    return frames
+
+def list_images(root_dir, videos=False):
+    """Returns list of all image (and video, when videos is True) files in root_dir (recursive scan)"""
+    extensions = IMAGE_EXTENSIONS | VIDEO_EXTENSIONS if videos else IMAGE_EXTENSIONS
+    all_images = []
+    for root, dirs, files in os.walk(root_dir):
+        for file in files:
+            ext = os.path.splitext(file)[1].lower()
+            if ext in extensions:
+                full_path = os.path.join(root, file)
+                all_images.append(full_path)
+    return sorted(all_images)  # stable order; needed to resume classification
+
+def load_cache(cache_file):
+    """Returns cached dict (path: result) from pickle file; empty dict when not cached"""
     if os.path.exists(cache_file):
         with open(cache_file, 'rb') as file:
-            txt_frac = pickle.load(file)
-    else:
-        txt_frac = {}
+            return pickle.load(file)
+    return {}
 
-    for path in tqdm(img_paths):
-        if path not in txt_frac:
-            img = Image.open(path).convert("RGB")
+def save_cache(cache, cache_file):
+    with open(cache_file, 'wb') as file:
+        pickle.dump(cache, file)
+
+def downscale(img, max_size):
+    """Downscales img so that its longest side is atmost max_size px"""
+    max_dim = max(img.size)
+    if max_dim > max_size:
+        scale = max_size / max_dim
+        new_size = (int(img.size[0] * scale), int(img.size[1] * scale))
+        img = img.resize(new_size, Image.LANCZOS)
+    return img
+
+def ocr_text_fraction(path):
+    """
+    Returns OCR text fraction of image file at path.
+    With --ocr-coarse-to-fine, OCR first runs at OCR_COARSE_SIZE px and is repeated at
+    OCR_FINE_SIZE px only when coarse pass finds small text (close to detection limit) or
+    the text fraction is close to MIN_TEXT_RATIO. Images no larger than OCR_COARSE_SIZE px
+    are never repeated, as both passes would see the same pixels.
+    """
+    img = Image.open(path).convert("RGB")
+
+    if args.ocr_coarse_to_fine:
+        coarse_img = downscale(img, OCR_COARSE_SIZE)
+        boxes = text_boxes(coarse_img)
+        txt_frac = text_area_ratio(coarse_img, boxes)
+        small_text = any(0 < height < OCR_SMALL_TEXT_PX for _, height in boxes)
+        if max(img.size) <= OCR_COARSE_SIZE or (
+                not small_text and abs(txt_frac - MIN_TEXT_RATIO) > OCR_ESCALATION_MARGIN):
+            ocr_pass_counts["coarse"] += 1
+            return txt_frac
+
+    # downscale huge images for faster OCR
+    ocr_pass_counts["fine"] += 1
+    return text_area_ratio(downscale(img, OCR_FINE_SIZE))
+
+def text_presence_score(path, size=256, edge=30, block=16, min_density=0.05):
+    """
+    Cheap (numpy-only) score of text-presence in image; 0 for images without any text-like
+    region. Text is made of dense, high-contrast strokes in both directions, so the score is
+    fraction of block x block tiles (on a size px grayscale thumbnail) with density of strong
+    horizontal and vertical edges both above min_density. Returns nan for unreadable images.
+    """
+    try:
+        img = Image.open(path)
+        img.draft("L", (size, size))  # fast DCT-scaling for jpegs
+        img = img.convert("L")
+        img.thumbnail((size, size), Image.NEAREST)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception:
+        return float("nan")
+
+    g = np.asarray(img, dtype=np.int16)
+    h, w = (g.shape[0] - 1) // block * block, (g.shape[1] - 1) // block * block
+    if h == 0 or w == 0:
+        return float("nan")
+
+    dx = np.abs(np.diff(g, axis=1))[:h, :w] > edge
+    dy = np.abs(np.diff(g, axis=0))[:h, :w] > edge
+    dens_x = dx.reshape(h // block, block, w // block, block).mean(axis=(1, 3))
+    dens_y = dy.reshape(h // block, block, w // block, block).mean(axis=(1, 3))
+    return float(((dens_x > min_density) & (dens_y > min_density)).mean())
+
+def text_presence_scores(img_paths):
+    """Returns np.ndarray of text_presence_score() of img_paths; computed in parallel"""
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2)) as executor:
+        return np.array(list(tqdm(executor.map(text_presence_score, img_paths), total=len(img_paths))))
+
+def ocr_prefilter(img_paths, txt_frac, recall, report_csv=None):
+    """
+    Returns set of img_paths that certainly do not have text (as per text_presence_score()),
+    so that OCR can be skipped for them.
 
-            # downscale huge images for faster OCR
-            max_dim = max(img.size)
-            if max_dim > 1200:
-                scale = 1200 / max_dim
-                new_size = (int(img.size[0] * scale), int(img.size[1] * scale))
-                img = img.resize(new_size, Image.LANCZOS)
-            txt_frac[path] = text_area_ratio(img)
+    The score cutoff is calibrated on images with known OCR text fraction (from txt_frac;
+    extended by running OCR on a random sample of img_paths when needed) such that at least
+    recall fraction of images with text fraction > MIN_TEXT_RATIO are still sent to OCR.
+    txt_frac is updated in place with OCR results of calibration sample.
+    """
+    known = [path for path in txt_frac if os.path.exists(path)][:OCR_PREFILTER_CALIBRATION]
+    if len(known) < OCR_PREFILTER_CALIBRATION:
+        n_sample = min(OCR_PREFILTER_CALIBRATION - len(known), len(img_paths))
+        print(f"OCR prefilter: running OCR on {n_sample} random images for calibration...")
+        for path in tqdm(random.Random(0).sample(img_paths, n_sample)):
+            txt_frac[path] = ocr_text_fraction(path)
+            known.append(path)
+
+    print("OCR prefilter: scoring text-presence...")
+    known_scores = text_presence_scores(known)
+    has_text = np.array([txt_frac[path] > MIN_TEXT_RATIO for path in known])
+    pos_scores = known_scores[has_text & ~np.isnan(known_scores)]
+    if len(pos_scores) < 10:
+        print(f"OCR prefilter: only {len(pos_scores)} images with text in calibration set; prefilter disabled.")
+        return set()
+    cutoff = np.quantile(pos_scores, 1 - recall, method="lower")
+
+    todo = [path for path in img_paths if path not in txt_frac]
+    scores = text_presence_scores(todo)
+    skip = {path for path, score in zip(todo, scores) if score < cutoff}  # nan is never skipped
+
+    print(f"OCR prefilter: {cutoff=:.4f} for recall >= {recall} on {len(known)} calibration images "
+          f"({len(pos_scores)} with text)")
+    print(f"OCR prefilter: avoided {len(skip)} of {len(todo)} OCR calls "
+          f"({100 * len(skip) / max(len(todo), 1):.1f}%)")
+
+    if report_csv is not None:
+        with open(report_csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["image_path", "text_presence_score", "ocr_skipped"])
+            for path, score in zip(todo, scores):
+                writer.writerow([path, round(float(score), 4), path in skip])
+    return skip
+
+def get_ocr_results(img_paths, cache_file, prefilter_recall=None, prefilter_report=None):
+    """
+    Compute ocr txt fraction and cache it.
+    When prefilter_recall is set, OCR is skipped (text fraction is 0) for images that
+    ocr_prefilter() finds to be without text. Skipped images are not cached.
+    """
+    txt_frac = load_cache(cache_file)
 
-    with open(cache_file, 'wb') as file:
-        pickle.dump(txt_frac, file)
+    skip = set()
+    if prefilter_recall is not None:
+        todo = [path for path in img_paths if path not in txt_frac]
+        if todo:
+            skip = ocr_prefilter(todo, txt_frac, prefilter_recall, prefilter_report)
+
+    for path in tqdm(img_paths):
+        if path not in txt_frac and path not in skip:
+            txt_frac[path] = ocr_text_fraction(path)
+
+    save_cache(txt_frac, cache_file)
+    if args.ocr_coarse_to_fine and sum(ocr_pass_counts.values()):
+        print(f"OCR finished at coarse resolution for {ocr_pass_counts['coarse']} images; "
+              f"escalated to fine resolution for {ocr_pass_counts['fine']} images")
+    txt_frac.update(dict.fromkeys(skip, 0.0))
     return txt_frac
 
 def is_duplicate(img_path, hash_dict):
@@ -343,16 +747,634 @@ def is_duplicate(img_path, hash_dict):
     except:
         return False
 
-# get all image files
-IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
-all_images = []
-for root, dirs, files in os.walk(SOURCE_DIR):
-    for file in files:
-        ext = os.path.splitext(file)[1].lower()
-        if ext in IMAGE_EXTENSIONS:
-            full_path = os.path.join(root, file)
-            all_images.append(full_path)
+class RunningStats:
+    """
+    Streaming mean & variance of a series of values, without storing the values.
+    Batches are merged using parallel variant of Welford's algorithm (Chan et al.)
+    """
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n, self.mean, self.m2 = n, mean, m2
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        if values.size == 0:
+            return
+        n_b, mean_b = values.size, float(values.mean())
+        m2_b = float(((values - mean_b) ** 2).sum())
+
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / n
+        self.m2 += m2_b + delta ** 2 * self.n * n_b / n
+        self.n = n
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.n) if self.n else float("nan")
+
+    def state(self):
+        return {"n": self.n, "mean": self.mean, "m2": self.m2}
+
+
+def load_checkpoint(path, run_key):
+    """Returns saved checkpoint (dict) if it belongs to run with same run_key; None otherwise"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception:
+        print(f"Could not read checkpoint: {path}")
+        return None
+
+    if checkpoint.get("run_key") != run_key:
+        print("Images or classification settings changed since last run; starting over.")
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """Atomically writes checkpoint (dict) as json"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# ------------------ CLIP ------------------
+def load_clip_model(model_name):
+    """Returns CLIP model (on device), its image-preprocess transform & tokenizer"""
+    model, _, preprocess = open_clip.create_model_and_transforms(
+        model_name,
+        pretrained='openai',
+        image_resize_mode='longest',  # 'shortest' is default; 'squash' is another option
+    )
+    model = model.to(device)
+    model.eval()
+    tokenizer = open_clip.get_tokenizer(model_name)
+    return model, preprocess, tokenizer
+
+def encode_prompts(prompts):
+    """Returns normalized CLIP text embeddings (np.ndarray; n_prompts x dim) of list of prompts"""
+    text_tokens = tokenizer(prompts).to(device)
+    with torch.no_grad():
+        text_features = model.encode_text(text_tokens)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+    return text_features.cpu().numpy()
+
+def encode_labels(labels):
+    """
+    Returns normalized text embeddings of all prompts in labels (dict of class: prompt-list)
+    and label_group_indices (dict of class: (start_idx, end_idx)) into rows of embeddings.
+    """
+    # CLIP needs a flat list of prompts
+    flat_labels = []
+    label_group_indices = {}
+
+    start_idx = 0
+    for group_name, prompts in labels.items():
+        flat_labels.extend(prompts)
+        end_idx = start_idx + len(prompts)
+        label_group_indices[group_name] = (start_idx, end_idx)
+        start_idx = end_idx
+
+    return encode_prompts(flat_labels), label_group_indices
+
+def clip_margins(image_features):
+    """Returns margins (meme-score - photo-score) of normalized image embeddings (n_images x dim)"""
+    similarity = image_features @ text_features.T
+    meme_start, meme_end = label_group_indices["memes"]
+    photo_start, photo_end = label_group_indices["photo"]
+    return (similarity[:, meme_start:meme_end].max(axis=1)
+            - similarity[:, photo_start:photo_end].max(axis=1))
+
+def encode_images(img_paths, best_frames=None):
+    """
+    Returns normalized CLIP image embeddings (np.ndarray; n_images x dim) and list of paths
+    that could be read. Unreadable images are skipped with a message.
+
+    Videos are represented by a few keyframes, which are encoded in the same batch as images.
+    Embedding of a video is that of its most meme-like keyframe (highest margin). When
+    best_frames (dict) is given, it is updated with video-path: that keyframe (PIL.Image).
+    """
+    images = []
+    valid_paths = []
+    owners = []  # index into valid_paths for each of images
+
+    for path in img_paths:
+        try:
+            if is_video(path):
+                frames = extract_keyframes(path)
+                if not frames:
+                    raise ValueError("no keyframes found")
+            else:
+                # img = preprocess_image(path)
+                frames = [Image.open(path).convert("RGB")]
+            images.extend(preprocess(img) for img in frames)
+            owners.extend([len(valid_paths)] * len(frames))
+            valid_paths.append((path, frames if is_video(path) else None))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as e:
+            print(f"exception occurred: {path}")
+            traceback.print_exc()
+
+    if not images:
+        return np.zeros((0, 0), dtype=np.float32), []
+
+    image_input = torch.stack(images).to(device)
+    with torch.no_grad():
+        image_features = image_encoder.encode_image(image_input)
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+    image_features = image_features.cpu().numpy()
+
+    # pick best keyframe of videos
+    owners = np.array(owners)
+    margins = clip_margins(image_features) if any(frames for _, frames in valid_paths) else None
+    rows = []
+    for i, (path, frames) in enumerate(valid_paths):
+        frame_rows = np.flatnonzero(owners == i)
+        best = frame_rows[margins[frame_rows].argmax()] if frames else frame_rows[0]
+        rows.append(best)
+        if frames and best_frames is not None:
+            best_frames[path] = frames[best - frame_rows[0]]
+
+    return image_features[rows], [path for path, _ in valid_paths]
+
+def get_image_features(img_paths, cache_file):
+    """Returns CLIP image embeddings for img_paths as dict; computes and caches missing ones"""
+    features = load_cache(cache_file)
+    missing = [path for path in img_paths if path not in features]
+    for i in tqdm(range(0, len(missing), BATCH_SIZE)):
+        batch_features, valid_paths = encode_images(missing[i:i+BATCH_SIZE])
+        features.update(zip(valid_paths, batch_features))
+
+    if missing:
+        save_cache(features, cache_file)
+    return features
+
+
+# ------------------ ONNX backend ------------------
+class _ImageTower(torch.nn.Module):
+    """Wraps encode_image() of CLIP model for ONNX export"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        return self.model.encode_image(image)
+
+
+class OnnxImageEncoder:
+    """
+    Drop-in replacement for model.encode_image() that runs int8-quantized image encoder
+    using onnxruntime. Exported & quantized model is cached in cache_dir.
+    """
+    def __init__(self, model, model_name, cache_dir, n_threads=None, image_size=224):
+        if onnxruntime is None:
+            raise RuntimeError("onnxruntime is not installed. Run: pip install onnx onnxruntime")
+
+        os.makedirs(cache_dir, exist_ok=True)
+        fp32_path = os.path.join(cache_dir, f"{model_name}_openai_image.onnx")
+        self.onnx_path = os.path.join(cache_dir, f"{model_name}_openai_image_int8.onnx")
+
+        if not os.path.exists(self.onnx_path):
+            print(f"Exporting CLIP image encoder to {self.onnx_path} (one time)...")
+            dummy = torch.randn(1, 3, image_size, image_size)
+            torch.onnx.export(
+                _ImageTower(model).cpu().eval(), dummy, fp32_path,
+                input_names=["image"], output_names=["features"],
+                dynamic_axes={"image": {0: "batch"}, "features": {0: "batch"}},
+                opset_version=17,
+            )
+            model.to(device)  # export needs model on cpu
+            quantize_dynamic(fp32_path, self.onnx_path, weight_type=QuantType.QInt8)
+            os.remove(fp32_path)
+
+        options = onnxruntime.SessionOptions()
+        if n_threads:
+            options.intra_op_num_threads = n_threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            self.onnx_path, options, providers=["CPUExecutionProvider"])
+
+    def encode_image(self, image_input):
+        image = image_input.detach().cpu().numpy().astype(np.float32)
+        features = self.session.run(["features"], {"image": image})[0]
+        return torch.from_numpy(features).to(image_input.device)
+
+
+def validate_onnx_backend(img_paths, out_csv):
+    """
+    Compares margins & decisions from onnx-int8 and torch fp32 image encoders on img_paths.
+    Writes per-image report to out_csv and prints summary.
+    """
+    global image_encoder
+    onnx_encoder = OnnxImageEncoder(model, model_name, CACHE_DIR, n_threads=num_threads)
+    rows = []
+    for i in tqdm(range(0, len(img_paths), BATCH_SIZE)):
+        batch = img_paths[i:i+BATCH_SIZE]
+        image_encoder = model
+        fp32_features, valid_paths = encode_images(batch)
+        image_encoder = onnx_encoder
+        int8_features, _ = encode_images(valid_paths)
+        if not valid_paths:
+            continue
+
+        for path, m32, m8 in zip(valid_paths, clip_margins(fp32_features), clip_margins(int8_features)):
+            rows.append([path, round(float(m32), 5), round(float(m8), 5),
+                         bool(m32 > THRESHOLD), bool(m8 > THRESHOLD)])
+
+    with open(out_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["image_path", "margin_fp32", "margin_int8", "meme_fp32", "meme_int8"])
+        writer.writerows(rows)
+
+    if not rows:
+        print("No images could be read for validation.")
+        return
+
+    diff = np.abs(np.array([r[1] - r[2] for r in rows]))
+    n_match = sum(r[3] == r[4] for r in rows)
+    print(f"Validated on {len(rows)} images ({THRESHOLD=})")
+    print(f"  margin decisions matching fp32: {n_match}/{len(rows)} ({100 * n_match / len(rows):.2f}%)")
+    print(f"  abs margin difference: mean={diff.mean():.5f}, max={diff.max():.5f}")
+    print("Validation report:", out_csv)
+
+
+# ------------------ Benchmark ------------------
+def load_tuned_config():
+    """Returns tuned config (dict of backend: settings) saved by --benchmark; empty dict if none"""
+    if os.path.exists(TUNED_CONFIG_FILE):
+        with open(TUNED_CONFIG_FILE) as f:
+            return json.load(f)
+    return {}
+
+def make_image_encoder(backend, num_threads):
+    """Returns image encoder for backend; num_threads is applied to torch or onnxruntime"""
+    if backend == "onnx-int8":
+        return OnnxImageEncoder(model, model_name, CACHE_DIR, n_threads=num_threads)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    return model
+
+def images_per_sec(fn, items):
+    """Returns (results, images/sec) of applying fn on each of items"""
+    tic = time.perf_counter()
+    results = [fn(item) for item in items]
+    return results, len(items) / max(time.perf_counter() - tic, 1e-9)
+
+def decode_image(path):
+    """Returns RGB image of file at path; None (after printing exception) for unreadable files"""
+    try:
+        return Image.open(path).convert("RGB")
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception:
+        print(f"exception occurred: {path}")
+        traceback.print_exc()
+        return None
+
+def run_benchmark(img_paths, out_json):
+    """
+    Measures per-stage throughput (images/sec) of decode, preprocess, encode_image & OCR on
+    img_paths. encode_image is measured for all combinations of BENCHMARK_BATCH_SIZES &
+    BENCHMARK_THREADS; the fastest combination is saved to TUNED_CONFIG_FILE and used by
+    later runs (unless overridden with --batch-size/--num-threads). Unreadable files are skipped.
+    """
+    global image_encoder
+    report = {"backend": args.backend, "device": device, "n_images": len(img_paths), "stages": {}}
+
+    images, rate = images_per_sec(decode_image, img_paths)
+    report["stages"]["decode"] = rate
+    img_paths = [path for path, img in zip(img_paths, images) if img is not None]  # skip unreadable files
+    images = [img for img in images if img is not None]
+    tensors, rate = images_per_sec(preprocess, images)
+    report["stages"]["preprocess"] = rate
+    _, rate = images_per_sec(ocr_text_fraction, img_paths[:BENCHMARK_OCR_IMAGES])
+    report["stages"]["ocr"] = rate
+    for stage, rate in report["stages"].items():
+        print(f"{stage:>12}: {rate:8.2f} images/sec")
+
+    thread_grid = BENCHMARK_THREADS if device == "cpu" else [None]
+    encode_results = []
+    for num_threads in thread_grid:
+        image_encoder = make_image_encoder(args.backend, num_threads)
+        for batch_size in BENCHMARK_BATCH_SIZES:
+            if batch_size > len(tensors):
+                continue
+            batches = [torch.stack(tensors[i:i + batch_size]).to(device)
+                       for i in range(0, len(tensors) - batch_size + 1, batch_size)]
+            with torch.no_grad():
+                image_encoder.encode_image(batches[0])  # warm-up
+                _, rate = images_per_sec(image_encoder.encode_image, batches)
+            rate *= batch_size  # per image
+            encode_results.append({"batch_size": batch_size, "num_threads": num_threads, "images_per_sec": rate})
+            print(f"encode_image: {rate:8.2f} images/sec ({batch_size=}, {num_threads=})")
+
+    if not encode_results:
+        print(f"Need atleast {min(BENCHMARK_BATCH_SIZES)} readable images for benchmark.")
+        return
+
+    best = max(encode_results, key=lambda r: r["images_per_sec"])
+    report["stages"]["encode_image"] = encode_results
+    report["best"] = best
+    with open(out_json, "w") as f:
+        json.dump(report, f, indent=2)
+
+    tuned_config = load_tuned_config()
+    tuned_config[args.backend] = {"batch_size": best["batch_size"], "num_threads": best["num_threads"]}
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(TUNED_CONFIG_FILE, "w") as f:
+        json.dump(tuned_config, f, indent=2)
+
+    print(f"Best: {best}")
+    print("Benchmark report:", out_json)
+    print("Saved tuned config:", TUNED_CONFIG_FILE)
+
+
+# ------------------ Clustering ------------------
+def kmeans(x, k, n_iter=10, seed=0):
+    """Spherical k-means of rows of x (normalized); returns normalized centroids (k x dim)"""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)]
+    for _ in range(n_iter):
+        assign = (x @ centroids.T).argmax(axis=1)
+        for c in range(k):
+            members = x[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+    return centroids
+
+def ivf_similar_pairs(x, sim_threshold, n_probe=4):
+    """
+    Returns list of index pairs (i, j), i < j, of rows of x (normalized embeddings) with
+    cosine similarity > sim_threshold. Uses an inverted-file (IVF) index: rows are bucketed by
+    their nearest k-means centroid and every row is only compared with rows in buckets of its
+    n_probe nearest centroids. Hence, it is approximate; but much faster than all pairs.
+    """
+    n = len(x)
+    k = max(1, int(math.sqrt(n)))
+    centroids = kmeans(x, k)
+    centroid_sim = x @ centroids.T
+    bucket = centroid_sim.argmax(axis=1)
+    probes = np.argsort(-centroid_sim, axis=1)[:, :min(n_probe, k)]
+
+    pairs = set()
+    for c in range(k):
+        members = np.flatnonzero(bucket == c)
+        queries = np.flatnonzero((probes == c).any(axis=1))
+        if len(members) == 0 or len(queries) == 0:
+            continue
+        qi, mi = np.nonzero(x[queries] @ x[members].T > sim_threshold)
+        for i, j in zip(queries[qi], members[mi]):
+            if i != j:
+                pairs.add((min(i, j), max(i, j)))
+    return sorted(pairs)
+
+def cluster_embeddings(x, sim_threshold):
+    """
+    Groups rows of x (normalized embeddings) into clusters of near-duplicates: connected
+    components of pairs with cosine similarity > sim_threshold.
+    Returns (labels, representatives): cluster label of each row & dict of label: row-index
+    of member closest to cluster mean.
+    """
+    parent = list(range(len(x)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in ivf_similar_pairs(x, sim_threshold):
+        parent[find(i)] = find(j)
+
+    labels = np.array([find(i) for i in range(len(x))])
+    representatives = {}
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        mean = x[members].mean(axis=0)
+        representatives[label] = members[(x[members] @ mean).argmax()]
+    return labels, representatives
+
+def cluster_candidates(csv_file, image_features, out_csv):
+    """
+    Clusters meme candidates (from classification csv) using their CLIP image embeddings and
+    writes cluster of each candidate to out_csv. Symlinks of all but cluster representative are
+    removed from REVIEW_DIR, so that review decision on representative applies to whole cluster.
+    Candidates without embeddings in image_features (classified before a resumed run) are encoded
+    again, and added to image_features.
+    """
+    with open(csv_file, newline="") as f:
+        paths = [row["image_path"] for row in csv.DictReader(f) if row["label_decision"] == "meme_candidate"]
+
+    missing = [path for path in paths if path not in image_features]
+    if missing:
+        print(f"Encoding {len(missing)} meme candidates classified before resume...")
+        for i in tqdm(range(0, len(missing), BATCH_SIZE)):
+            batch_features, valid_paths = encode_images(missing[i:i+BATCH_SIZE])
+            image_features.update(zip(valid_paths, batch_features))
+        paths = [path for path in paths if path in image_features]  # skip files unreadable now
+    if not paths:
+        return
+
+    x = np.stack([image_features[path] for path in paths]).astype(np.float32)
+    labels, representatives = cluster_embeddings(x, CLUSTER_SIMILARITY)
+    sizes = dict(zip(*np.unique(labels, return_counts=True)))
+
+    with open(out_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["image_path", "cluster_id", "representative_path", "cluster_size"])
+        for path, label in zip(paths, labels):
+            writer.writerow([path, label, paths[representatives[label]], sizes[label]])
+
+    for path, label in zip(paths, labels):
+        if path != paths[representatives[label]]:
+            symlink_path = os.path.join(REVIEW_DIR, os.path.relpath(path, SOURCE_DIR))
+            if os.path.islink(symlink_path):
+                os.unlink(symlink_path)
+    delete_empty_dir_recursively(REVIEW_DIR)
+
+    print(f"Grouped {len(paths)} meme candidates into {len(sizes)} clusters "
+          f"(largest: {max(sizes.values())} images)")
+
+
+# ------------------ Sweep ------------------
+def read_labeled_csv(labeled_csv):
+    """
+    Returns list of paths & boolean np.ndarray (True for meme) from hand-labeled csv.
+    Label is read from column label (meme/keep) or label_decision (meme_candidate/keep).
+    Relative paths are relative to SOURCE_DIR.
+    """
+    paths, is_meme = [], []
+    with open(labeled_csv, newline="") as f:
+        for row in csv.DictReader(f):
+            label = (row.get("label") or row.get("label_decision") or "").strip().lower()
+            if label not in ("meme", "meme_candidate", "keep"):
+                print(f"Skipping row with unknown label: {row}")
+                continue
+            paths.append(os.path.join(SOURCE_DIR, row["image_path"]))
+            is_meme.append(label != "keep")
+    return paths, np.array(is_meme, dtype=bool)
+
+def candidate_prompt_sets(labels, prompts_json=None):
+    """
+    Returns dict of name: prompt-set (same structure as labels). Includes current labels,
+    all its leave-one-prompt-out variants and prompt-sets from prompts_json (if any).
+    """
+    prompt_sets = {"current": labels}
+    for group_name, prompts in labels.items():
+        if len(prompts) < 2:
+            continue
+        for i in range(len(prompts)):
+            variant = dict(labels)
+            variant[group_name] = prompts[:i] + prompts[i+1:]
+            prompt_sets[f"drop_{group_name}[{i}]"] = variant
+
+    if prompts_json is not None:
+        with open(prompts_json) as f:
+            for i, prompt_set in enumerate(json.load(f)):
+                prompt_sets[f"json[{i}]"] = prompt_set
+    return prompt_sets
+
+def sweep_scores(similarity, text_ratio, is_meme, meme_mask, photo_mask, thresholds, text_ratios):
+    """
+    Scores all combinations of prompt-sets, thresholds & text-ratios in one shot.
+
+    Args:
+        similarity: np.ndarray (n_images x n_prompts) of image-prompt similarity
+        text_ratio: np.ndarray (n_images) of OCR text fraction
+        is_meme: boolean np.ndarray (n_images) of ground-truth
+        meme_mask, photo_mask: boolean np.ndarray (n_sets x n_prompts) marking prompts
+                               in each class of every prompt-set
+        thresholds, text_ratios: 1D np.ndarray of THRESHOLD & MIN_TEXT_RATIO to try
+
+    Returns:
+        tp, fp, fn: np.ndarray (n_sets x n_thresholds x n_text_ratios) of counts
+    """
+    sim = similarity[:, None, :]
+    meme_score = np.where(meme_mask[None], sim, -np.inf).max(axis=-1)  # n_images x n_sets
+    photo_score = np.where(photo_mask[None], sim, -np.inf).max(axis=-1)
+    margin = meme_score - photo_score
+
+    # n_images x n_sets x n_thresholds x n_text_ratios
+    pred = ((margin[:, :, None, None] > thresholds[None, None, :, None])
+            | (text_ratio[:, None, None, None] > text_ratios[None, None, None, :]))
+
+    y = is_meme[:, None, None, None]
+    tp = (pred & y).sum(axis=0)
+    fp = (pred & ~y).sum(axis=0)
+    fn = is_meme.sum() - tp
+    return tp, fp, fn
+
+def run_sweep(labeled_csv, prompts_json, out_csv):
+    """Sweeps prompt-sets & thresholds on hand-labeled images and writes precision/recall to out_csv"""
+    paths, is_meme = read_labeled_csv(labeled_csv)
+    if any(is_video(path) for path in paths):
+        print("Videos are not supported by sweep; skipping them.")
+        is_meme = is_meme[[not is_video(path) for path in paths]]
+        paths = [path for path in paths if not is_video(path)]
+    print(f"Labeled images: {len(paths)} ({is_meme.sum()} memes)")
+
+    print("loading / computing CLIP image features...")
+    features = get_image_features(paths, clip_feature_file)
+    print("loading / computing OCR text fraction...")
+    txt_frac = get_ocr_results(paths, ocr_result_file)
+
+    keep = np.array([path in features for path in paths], dtype=bool)
+    paths = [path for path, k in zip(paths, keep) if k]
+    is_meme = is_meme[keep]
+    image_features = np.stack([features[path] for path in paths])
+    text_ratio = np.array([txt_frac[path] for path in paths], dtype=float)
+
+    # encode each unique prompt once
+    prompt_sets = candidate_prompt_sets(labels, prompts_json)
+    all_prompts = sorted({p for ps in prompt_sets.values() for prompts in ps.values() for p in prompts})
+    prompt_idx = {p: i for i, p in enumerate(all_prompts)}
+    meme_mask = np.zeros((len(prompt_sets), len(all_prompts)), dtype=bool)
+    photo_mask = np.zeros_like(meme_mask)
+    for k, ps in enumerate(prompt_sets.values()):
+        meme_mask[k, [prompt_idx[p] for p in ps["memes"]]] = True
+        photo_mask[k, [prompt_idx[p] for p in ps["photo"]]] = True
+
+    similarity = image_features @ encode_prompts(all_prompts).T
+    tp, fp, fn = sweep_scores(similarity, text_ratio, is_meme, meme_mask, photo_mask,
+                              SWEEP_THRESHOLDS, SWEEP_TEXT_RATIOS)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = np.nan_to_num(tp / (tp + fp), nan=1.0)
+        recall = np.nan_to_num(tp / (tp + fn), nan=0.0)
+
+    rows = []
+    for k, t, r in np.ndindex(tp.shape):
+        rows.append([
+            list(prompt_sets)[k],
+            SWEEP_THRESHOLDS[t],
+            SWEEP_TEXT_RATIOS[r],
+            tp[k, t, r], fp[k, t, r], fn[k, t, r],
+            round(float(precision[k, t, r]), 4),
+            round(float(recall[k, t, r]), 4)])
+    rows.sort(key=lambda row: (row[6], row[7]), reverse=True)  # low false +ve first
+
+    with open(out_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["prompt_set", "threshold", "min_text_ratio", "tp", "fp", "fn", "precision", "recall"])
+        writer.writerows(rows)
+    with open(os.path.splitext(out_csv)[0] + "_prompt_sets.json", "w") as f:
+        json.dump(prompt_sets, f, indent=2)
+
+    print(f"Swept {len(rows)} configurations. Top configurations:")
+    for row in rows[:10]:
+        print(row)
+    print("Sweep report:", out_csv)
+
+
+# Use the explicit quickgelu variant name
+model_name = 'ViT-B-32-quickgelu'
+model, preprocess, tokenizer = load_clip_model(model_name)
+
+# batch size & threads: command line > tuned config from --benchmark > defaults
+tuned_config = load_tuned_config().get(args.backend, {})
+BATCH_SIZE = args.batch_size or tuned_config.get("batch_size", BATCH_SIZE)
+num_threads = args.num_threads or tuned_config.get("num_threads")
+print(f"{BATCH_SIZE=}, {num_threads=}")
+image_encoder = model
+
+# CLIP text embeddings of prompts
+text_features, label_group_indices = encode_labels(labels)
+pprint(labels)
+pprint(label_group_indices)
+
+# Compare onnx-int8 backend with torch if --validate-onnx is set
+if args.validate_onnx:
+    sample = list_images(SOURCE_DIR)
+    sample = random.Random(0).sample(sample, min(args.validate_onnx, len(sample)))
+    validate_onnx_backend(sample, onnx_validation_path)
+    exit(0)
+
+# Find best batch size & threads if --benchmark is set
+if args.benchmark:
+    sample = list_images(SOURCE_DIR)
+    sample = random.Random(0).sample(sample, min(args.benchmark, len(sample)))
+    run_benchmark(sample, benchmark_path)
+    exit(0)
+
+image_encoder = make_image_encoder(args.backend, num_threads)
 
+# Tune prompts & thresholds if --sweep is set
+if args.sweep:
+    run_sweep(os.path.abspath(args.sweep), args.sweep_prompts, sweep_path)
+    exit(0)
+
+# get all image files
+all_images = list_images(SOURCE_DIR, videos=args.videos)
 print(f"Found total image files: {len(all_images)}")
 
 # # Duplicate detection
@@ -368,108 +1390,252 @@ unique_images = all_images
 print(f"Unique images: {len(unique_images)}")
 
 print("ocr computing / caching...")
-txt_frac = get_ocr_results(unique_images, ocr_result_file)
+txt_frac = get_ocr_results([path for path in unique_images if not is_video(path)], ocr_result_file,
+                           prefilter_recall=args.ocr_prefilter_recall, prefilter_report=ocr_prefilter_path)
+
+
+def write_thumbnail(img_path, thumb_path, max_size=THUMBNAIL_SIZE):
+    """Writes small jpeg thumbnail of img_path; skipped when thumbnail is newer than image"""
+    try:
+        if (os.path.exists(thumb_path)
+                and os.path.getmtime(thumb_path) >= os.path.getmtime(img_path)):
+            return True
+
+        if is_video(img_path):
+            img = extract_keyframes(img_path, n_frames=1)[0]
+        else:
+            img = Image.open(img_path)
+            img.draft("RGB", (max_size, max_size))  # fast DCT-scaling for jpegs
+            img = img.convert("RGB")
+        img.thumbnail((max_size, max_size), Image.BILINEAR)
+        img.save(thumb_path, "JPEG", quality=75)
+        return True
+
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception as e:
+        print(f"Could not write thumbnail for {img_path}: {e}")
+        return False
+
+
+def write_thumbnails(img_paths, thumb_dir, n_workers=None):
+    """
+    Writes thumbnails of img_paths to thumb_dir in parallel (PIL releases GIL while
+    decoding/resizing). Returns dict of img_path: thumbnail-file-name (relative to thumb_dir).
+    """
+    os.makedirs(thumb_dir, exist_ok=True)
+    thumbs = {path: hashlib.sha1(path.encode("utf-8")).hexdigest() + ".jpg" for path in img_paths}
+
+    n_workers = n_workers or min(32, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {path: executor.submit(write_thumbnail, path, os.path.join(thumb_dir, thumb))
+                   for path, thumb in thumbs.items()}
+        for path in tqdm(futures):
+            if not futures[path].result():
+                thumbs[path] = None
+    return thumbs
 
 
-def generate_html_dashboard(csv_file, out_html):
+def generate_html_dashboard(csv_file, out_html, clusters_csv=None, rows_per_page=1000):
+    """
+    Writes a light-weight HTML dashboard. Scores are written as pages of json rows
+    (wrapped as javascript, so that they can be loaded from file:// urls) next to
+    out_html and loaded in the background. Only the rows visible on screen are rendered
+    and sorting is done on the data array, so that it stays responsive for >20K images.
+    When clusters_csv is given, only representative of each cluster of meme candidates is
+    shown, along with its cluster size.
+    """
     rows = []
     with open(csv_file, newline="") as f:
         reader = csv.DictReader(f)
         for row in reader:
             rows.append(row)
 
-    html = f"""
+    clusters = read_clusters(clusters_csv) if clusters_csv else {}
+    rows = [row for row in rows
+            if row["image_path"] not in clusters or clusters[row["image_path"]][0] == row["image_path"]]
+
+    out_dir = os.path.dirname(out_html)
+    thumb_dir = os.path.join(out_dir, "thumbnails")
+    data_dir_name = os.path.splitext(os.path.basename(out_html))[0] + "_data"
+    data_dir = os.path.join(out_dir, data_dir_name)
+
+    print("Writing thumbnails...")
+    thumbs = write_thumbnails([row["image_path"] for row in rows], thumb_dir)
+
+    # score data in pages
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir)
+    n_pages = 0
+    for start in range(0, len(rows), rows_per_page):
+        page = []
+        for row in rows[start:start + rows_per_page]:
+            thumb = thumbs.get(row["image_path"])
+            page.append({
+                "image": Path(row["image_path"]).as_uri(),
+                "thumb": f"thumbnails/{thumb}" if thumb else None,
+                "label_decision": row["label_decision"],
+                "text_ratio": float(row["text_ratio"]),
+                "meme_score": row["meme_score"],
+                "photo_score": row["photo_score"],
+                "margin": float(row["margin"]),
+                "cluster_size": clusters.get(row["image_path"], (None, ""))[1],
+            })
+        with open(os.path.join(data_dir, f"page_{n_pages:05d}.js"), "w", encoding="utf-8") as f:
+            f.write("loadPage(" + json.dumps(page) + ");\n")
+        n_pages += 1
+
+    html = """
 <!DOCTYPE html>
 <html>
 <head>
 <meta charset="UTF-8">
 <title>WhatsApp Meme Classification Dashboard</title>
 <style>
-body {{
+body {
     font-family: Arial, sans-serif;
     background-color: #f5f5f5;
-}}
-table {{
-    border-collapse: collapse;
-    width: 100%;
-}}
-th, td {{
-    border: 1px solid #ddd;
-    padding: 8px;
+    margin: 8px;
+}
+.row {
+    display: grid;
+    grid-template-columns: 170px 150px 1fr 2fr 2fr 1fr 1fr;
+    align-items: center;
     text-align: center;
-}}
-th {{
+    box-sizing: border-box;
+    border-bottom: 1px solid #ddd;
+}
+#header {
     background-color: #333;
     color: white;
-    cursor: pointer;
-}}
-tr:nth-child(even) {{ background-color: #fafafa; }}
-tr.meme_candidate {{ background-color: #ffe6e6; }}
-img {{
+    height: 36px;
+}
+#header div { cursor: pointer; }
+#viewport {
+    height: calc(100vh - 140px);
+    overflow-y: auto;
+    background-color: white;
+}
+#spacer { position: relative; }
+#spacer .row {
+    position: absolute;
+    left: 0;
+    right: 0;
+    height: __ROW_HEIGHT__px;
+}
+#spacer .row:nth-child(even) { background-color: #fafafa; }
+#spacer .row.meme_candidate { background-color: #ffe6e6; }
+.row div { overflow-wrap: anywhere; padding: 4px; }
+img {
     max-width: 150px;
     max-height: 150px;
-}}
+}
 </style>
 </head>
 <body>
 
 <h2>WhatsApp Meme Classification Dashboard</h2>
-<p>Total Images: {len(rows)}</p>
-
-<table id="dataTable">
-<thead>
-<tr>
-<th>Image</th>
-<th>Decision</th>
-<th>Text fraction</th>
-<th>Meme Score</th>
-<th>Photo Score</th>
-<th>Margin</th>
-</tr>
-</thead>
-<tbody>
-"""
+<p>Total Images: __N_ROWS__ &nbsp; <span id="status"></span></p>
+
+<div id="header" class="row">
+<div data-key="image">Image</div>
+<div data-key="label_decision">Decision</div>
+<div data-key="text_ratio">Text fraction</div>
+<div data-key="meme_score">Meme Score</div>
+<div data-key="photo_score">Photo Score</div>
+<div data-key="margin">Margin</div>
+<div data-key="cluster_size">Cluster size</div>
+</div>
+<div id="viewport"><div id="spacer"></div></div>
 
-    for row in rows:
-        image_path = Path(row["image_path"]).as_uri()
-        decision = row["label_decision"]
-
-        html += f"""
-<tr class="{decision}">
-<td><img src="{image_path}"></td>
-<td>{decision}</td>
-<td>{row['text_ratio']}</td>
-<td>{row['meme_score']}</td>
-<td>{row['photo_score']}</td>
-<td>{row['margin']}</td>
-</tr>
-"""
+<script>
+const ROW_HEIGHT = __ROW_HEIGHT__;
+const N_PAGES = __N_PAGES__;
+const DATA_DIR = "__DATA_DIR__";
+const OVERSCAN = 5;
+
+const viewport = document.getElementById("viewport");
+const spacer = document.getElementById("spacer");
+const statusText = document.getElementById("status");
+let rows = [];
+let sortKey = null, sortAsc = true;
+let nextPage = 0;
+
+function esc(s) {
+    return String(s).replace(/[&<>"']/g, c => ({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"}[c]));
+}
 
-    html += """
-</tbody>
-</table>
+function compare(a, b) {
+    const A = a[sortKey], B = b[sortKey];
+    const c = (typeof A === "number") ? A - B
+            : String(A).localeCompare(String(B), undefined, {numeric: true});
+    return sortAsc ? c : -c;
+}
 
-<script>
-// Simple column sorting
-document.querySelectorAll("th").forEach((header, index) => {
+function render() {
+    spacer.style.height = (rows.length * ROW_HEIGHT) + "px";
+    const first = Math.max(0, Math.floor(viewport.scrollTop / ROW_HEIGHT) - OVERSCAN);
+    const last = Math.min(rows.length, first + Math.ceil(viewport.clientHeight / ROW_HEIGHT) + 2 * OVERSCAN);
+    let html = "";
+    for (let i = first; i < last; i++) {
+        const r = rows[i];
+        const img = r.thumb ? `<img loading="lazy" src="${esc(r.thumb)}">` : "(no thumbnail)";
+        html += `<div class="row ${esc(r.label_decision)}" style="top:${i * ROW_HEIGHT}px">`
+              + `<div><a href="${esc(r.image)}" target="_blank" title="${esc(r.image)}">${img}</a></div>`
+              + `<div>${esc(r.label_decision)}</div>`
+              + `<div>${r.text_ratio}</div>`
+              + `<div>${esc(r.meme_score)}</div>`
+              + `<div>${esc(r.photo_score)}</div>`
+              + `<div>${r.margin}</div>`
+              + `<div>${r.cluster_size}</div></div>`;
+    }
+    spacer.innerHTML = html;
+}
+
+// called by each data page
+function loadPage(pageRows) {
+    rows.push(...pageRows);
+    if (sortKey) rows.sort(compare);
+    statusText.textContent = nextPage < N_PAGES ? `(loaded ${rows.length} rows...)` : "";
+    render();
+    loadNextPage();
+}
+
+function loadNextPage() {
+    if (nextPage >= N_PAGES) return;
+    const s = document.createElement("script");
+    s.src = `${DATA_DIR}/page_${String(nextPage).padStart(5, "0")}.js`;
+    nextPage++;
+    document.body.appendChild(s);
+}
+
+// Column sorting on data array; only visible rows are re-rendered
+document.querySelectorAll("#header div").forEach(header => {
     header.addEventListener("click", () => {
-        const table = header.closest("table");
-        const rows = Array.from(table.querySelectorAll("tbody tr"));
-        const asc = header.classList.toggle("asc");
-        rows.sort((a, b) => {
-            const A = a.children[index].innerText;
-            const B = b.children[index].innerText;
-            return asc ? A.localeCompare(B, undefined, {numeric: true})
-                       : B.localeCompare(A, undefined, {numeric: true});
-        });
-        rows.forEach(row => table.querySelector("tbody").appendChild(row));
+        sortAsc = (sortKey === header.dataset.key) ? !sortAsc : true;
+        sortKey = header.dataset.key;
+        rows.sort(compare);
+        render();
     });
 });
+
+let pending = false;
+viewport.addEventListener("scroll", () => {
+    if (pending) return;
+    pending = true;
+    requestAnimationFrame(() => { pending = false; render(); });
+});
+window.addEventListener("resize", render);
+loadNextPage();
 </script>
 
 </body>
 </html>
 """
+    html = (html.replace("__ROW_HEIGHT__", "170")
+                .replace("__N_ROWS__", str(len(rows)))
+                .replace("__N_PAGES__", str(n_pages))
+                .replace("__DATA_DIR__", data_dir_name))
 
     with open(out_html, "w", encoding="utf-8") as f:
         f.write(html)
@@ -479,77 +1645,63 @@ document.querySelectorAll("th").forEach((header, index) => {
     return html
 
 
-# Use the explicit quickgelu variant name
-model_name = 'ViT-B-32-quickgelu'
-model, _, preprocess = open_clip.create_model_and_transforms(
-    model_name,
-    pretrained='openai',
-    image_resize_mode='longest',  # 'shortest' is default; 'squash' is another option
-)
-
-model = model.to(device)
-model.eval()
-tokenizer = open_clip.get_tokenizer(model_name)
-
-# CLIP needs a flat list of prompts
-flat_labels = []
-label_group_indices = {}
-
-start_idx = 0
-for group_name, prompts in labels.items():
-    flat_labels.extend(prompts)
-    end_idx = start_idx + len(prompts)
-    label_group_indices[group_name] = (start_idx, end_idx)
-    start_idx = end_idx
-pprint(flat_labels)
-pprint(label_group_indices)
-
-text_tokens = tokenizer(flat_labels).to(device)
-with torch.no_grad():
-    text_features = model.encode_text(text_tokens)
-    text_features /= text_features.norm(dim=-1, keepdim=True)
-
-# for logging
-report_file = open(report_path, "w")
-csv_file = open(csv_path, "w", newline="")
-csv_writer = csv.writer(csv_file)
-csv_writer.writerow([
-    "image_path",
-    "meme_score",
-    "photo_score",
-    "margin",
-    "label_decision",
-    "text_ratio"])
+# Resume from checkpoint of interrupted run, if any
+run_key = hashlib.sha1(json.dumps(
+    [unique_images, labels, THRESHOLD, MIN_TEXT_RATIO, model_name, args.backend, args.cluster, VIDEO_KEYFRAMES]).encode("utf-8")).hexdigest()
+checkpoint = None if args.restart else load_checkpoint(checkpoint_path, run_key)
+
+if checkpoint is not None:
+    print(f"Resuming classification from image {checkpoint['n_done']} of {len(unique_images)}")
+    # drop partial rows written after last checkpoint
+    report_file = open(report_path, "a")
+    report_file.truncate(checkpoint["report_offset"])
+    report_file.seek(0, os.SEEK_END)  # truncate() does not move position; tell() must give new end
+    csv_file = open(csv_path, "a", newline="")
+    csv_file.truncate(checkpoint["csv_offset"])
+    csv_file.seek(0, os.SEEK_END)
+    csv_writer = csv.writer(csv_file)
+    margin_stats = RunningStats(**checkpoint["margin_stats"])
+
+else:
+    # ---- Clean old symlinks from REVIEW_DIR recursively ----
+    for root, dirs, files in os.walk(REVIEW_DIR):
+        for entry in files + dirs:
+            full_path = os.path.join(root, entry)
+
+            # Remove only symbolic links
+            if os.path.islink(full_path):
+                os.unlink(full_path)
+    delete_empty_dir_recursively(REVIEW_DIR)
+    if os.path.exists(clusters_path):
+        os.remove(clusters_path)
+
+    # for logging
+    report_file = open(report_path, "w")
+    csv_file = open(csv_path, "w", newline="")
+    csv_writer = csv.writer(csv_file)
+    csv_writer.writerow([
+        "image_path",
+        "meme_score",
+        "photo_score",
+        "margin",
+        "label_decision",
+        "text_ratio",
+        "file_size",
+        "file_mtime_ns"])
+    margin_stats = RunningStats()
+    checkpoint = {"run_key": run_key, "n_done": 0}
 
 
 # Batch classification
-def process_batch(batch_paths, txt_frac):
-    images = []
-    valid_paths = []
-
-    for path in batch_paths:
-        try:
-            # img = preprocess_image(path)
-            img = Image.open(path).convert("RGB")
-            images.append(preprocess(img))
-            valid_paths.append(path)
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except Exception as e:
-            print(f"exception occurred: {path}")
-            traceback.print_exc()
-
-    if not images:
+def process_batch(batch_paths, txt_frac, image_features_cache):
+    best_frames = {}  # of videos
+    image_features, valid_paths = encode_images(batch_paths, best_frames)
+    if not valid_paths:
         return []
 
-    image_input = torch.stack(images).to(device)
-
-    with torch.no_grad():
-        image_features = model.encode_image(image_input)
-        image_features /= image_features.norm(dim=-1, keepdim=True)
-        similarity = image_features @ text_features.T
+    image_features_cache.update(zip(valid_paths, image_features))
+    similarity = image_features @ text_features.T
 
-    similarity = similarity.cpu().numpy()
     margin_list = []
     for i, path in enumerate(valid_paths):
 
@@ -564,16 +1716,19 @@ def process_batch(batch_paths, txt_frac):
         margin = meme_score - photo_score
         margin_list.append(margin)
 
-        # OCR text detection
+        # OCR text detection; for videos, only on best keyframe
         if path in txt_frac:
             text_ratio = txt_frac[path]
+        elif path in best_frames:
+            text_ratio = text_area_ratio(best_frames[path])
         else:
             text_ratio = text_area_ratio(preprocess_image(path))
 
         # Decision: meme if margin > THRESHOLD OR text_ratio > MIN_TEXT_RATIO
         decision = "meme_candidate" if (margin > THRESHOLD or text_ratio > MIN_TEXT_RATIO) else "keep"
 
-        # Write to CSV
+        # Write to CSV; size & mtime guard --proceed-to-* against files changed after classification
+        st = os.stat(path)
         csv_writer.writerow([
             path,
             np.array2string(meme_score_arr, precision=4, floatmode='fixed'), #round(meme_score, 4),
@@ -581,6 +1736,8 @@ def process_batch(batch_paths, txt_frac):
             round(margin, 4),
             decision,
             round(text_ratio, 4),
+            st.st_size,
+            st.st_mtime_ns,
         ])
 
         if decision == "meme_candidate":
@@ -592,6 +1749,8 @@ def process_batch(batch_paths, txt_frac):
             symlink_dir = os.path.dirname(symlink_path)
             os.makedirs(symlink_dir, exist_ok=True)
 
+            if os.path.islink(symlink_path):  # left over from interrupted run
+                os.unlink(symlink_path)
             os.symlink(path, symlink_path)
             report_file.write(path + "\n")
 
@@ -600,23 +1759,39 @@ def process_batch(batch_paths, txt_frac):
 
 
 print("Classifying images...")
-margin_all = []
-for i in tqdm(range(0, len(unique_images), BATCH_SIZE)):
+image_features_cache = load_cache(clip_feature_file)
+for i in tqdm(range(checkpoint["n_done"], len(unique_images), BATCH_SIZE)):
     batch = unique_images[i:i+BATCH_SIZE]
-    margin_all = margin_all + process_batch(batch, txt_frac)
+    margin_stats.update(process_batch(batch, txt_frac, image_features_cache))
+
+    # commit batch
+    for f in (report_file, csv_file):
+        f.flush()
+        os.fsync(f.fileno())
+    checkpoint.update({
+        "n_done": i + len(batch),
+        "report_offset": report_file.tell(),
+        "csv_offset": csv_file.tell(),
+        "margin_stats": margin_stats.state(),
+    })
+    save_checkpoint(checkpoint_path, checkpoint)
 
 report_file.close()
 csv_file.close()
 
+if args.cluster:
+    print("Clustering meme candidates...")
+    cluster_candidates(csv_path, image_features_cache, clusters_path)
+save_cache(image_features_cache, clip_feature_file)  # for tuning with --sweep
+
 
 # stats of actual margins; as CLIP scores seems to be always in small range.
-margin_all = np.array(margin_all)
-print(f'mean margin: {margin_all.mean()}')
-print(f'std margin: {margin_all.std()}')
-dynamic_threshold = margin_all.mean() + 0.5*margin_all.std()
+print(f'mean margin: {margin_stats.mean}')
+print(f'std margin: {margin_stats.std}')
+dynamic_threshold = margin_stats.mean + 0.5*margin_stats.std
 print(f'{dynamic_threshold=}')
 
-generate_html_dashboard(csv_path, html_path)
+generate_html_dashboard(csv_path, html_path, clusters_path)
 print("Done. Review images in:", REVIEW_DIR)
 print("For bulk delete:   xargs -a meme_candidates.txt rm")
 print("Or after reviewing files run again with --proceed-to-delete")